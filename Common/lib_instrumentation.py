@@ -0,0 +1,155 @@
+import math
+import threading
+import time
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+
+#latency histogram layout: SUB_BUCKETS logarithmic buckets per factor of two
+#(about 19% wide), from 1 us up to 2**(NUMBER_OF_BUCKETS/SUB_BUCKETS) us
+#(about 18 minutes). Slower calls land in the last bucket.
+SUB_BUCKETS = 4
+NUMBER_OF_BUCKETS = 120
+#operations reported by statistics() and histograms(), in order of first use
+MAX_OPERATIONS = 64
+
+
+
+def bucket_edges():
+    """Upper edge in microseconds of every histogram bucket."""
+    return [2.0**((i + 1.0)/SUB_BUCKETS) for i in range(NUMBER_OF_BUCKETS)]
+
+
+class OperationStats:
+    """Call count, error count and latency histogram of one operation."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0]*NUMBER_OF_BUCKETS
+
+    def add(self, seconds, error):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        us = seconds*1e6
+        i = int(math.log(us, 2)*SUB_BUCKETS) if us > 1 else 0
+        self.buckets[min(i, NUMBER_OF_BUCKETS - 1)] += 1
+
+    def percentile(self, fraction):
+        """Upper bucket edge below which fraction of the calls fall, in us."""
+        if self.count == 0:
+            return 0.0
+        rank = fraction*self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return 2.0**((i + 1.0)/SUB_BUCKETS)
+        return 2.0**(float(NUMBER_OF_BUCKETS)/SUB_BUCKETS)
+
+
+
+class Instrumentation:
+    """Per-operation call statistics of a driver or serial link.
+
+    Recording a call is a few additions under a lock, cheap next to any
+    driver call or serial transaction. The first MAX_OPERATIONS operations
+    are reported, in the order they were first seen.
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, error=False):
+        with self.lock:
+            stats = self.operations.get(name)
+            if stats is None:
+                stats = self.operations[name] = OperationStats()
+                self.order.append(name)
+            stats.add(seconds, error)
+
+    def timed(self, name):
+        """Context manager recording the duration of its block as one call
+        of name, as an error if the block raises."""
+        return _Timer(self, name)
+
+    def wrap(self, function, name):
+        """Return function recording every call as operation name."""
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                self.record(name, clock() - start, True)
+                raise
+            self.record(name, clock() - start)
+            return result
+        return wrapper
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+            self.order = []
+
+    def totals(self):
+        """(calls, errors) over all operations."""
+        with self.lock:
+            return (sum(stats.count for stats in self.operations.values()),
+                    sum(stats.errors for stats in self.operations.values()))
+
+    def statistics(self):
+        """One line per operation: name, calls, errors and the mean, median,
+        99th percentile and maximum latency in us."""
+        with self.lock:
+            return ["%s calls=%d errors=%d mean=%.0f p50=%.0f p99=%.0f max=%.0f"
+                    %(name, stats.count, stats.errors,
+                      stats.total/stats.count*1e6 if stats.count else 0.0,
+                      stats.percentile(0.5), stats.percentile(0.99), stats.max*1e6)
+                    for name, stats in ((name, self.operations[name])
+                                        for name in self.order[:MAX_OPERATIONS])]
+
+    def histograms(self):
+        """Bucket counts of every operation, rows in the order of statistics()."""
+        with self.lock:
+            return [list(self.operations[name].buckets) for name in self.order[:MAX_OPERATIONS]]
+
+
+class _Timer:
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.record(self.name, clock() - self.start, exc_type is not None)
+        return False
+
+
+
+class InstrumentedFunctions:
+    """Proxy of a table of functions (e.g. a ctypes library) recording every
+    call under the function name."""
+
+    def __init__(self, functions, instrumentation):
+        self._functions = functions
+        self._instrumentation = instrumentation
+
+    def __getattr__(self, name):
+        function = self._instrumentation.wrap(getattr(self._functions, name), name)
+        setattr(self, name, function)
+        return function
@@ -0,0 +1,167 @@
+#Asyncio serial transport shared by the monochromator and pump libraries
+#(Python 3, POSIX). Every port has a queue of transactions served one at a
+#time by a worker task; a transaction writes a command and reads a given
+#number of terminator framed response lines, with a timeout, and can be
+#cancelled while queued or running. Several ports on one event loop work
+#concurrently, e.g. from one orchestration process:
+#
+#    mono = SerialTransport("/dev/ttyUSB1")
+#    pump = SerialTransport("/dev/ttyUSB0", terminator=b"\n")
+#    await mono.open(); await pump.open()
+#    await asyncio.gather(mono.transaction(b"GOWAVE 500\n", 1),
+#                         pump.transaction(b"/1A3000R\r", 1))
+#
+#SyncSerialTransport is the blocking facade used by lib_monochromator.Mono
+#and lib_xlp6000.Pump: it runs its transport on an event loop in a shared
+#background thread.
+
+import asyncio
+import concurrent.futures
+import threading
+
+import serial
+
+
+
+class SerialTimeout(IOError):
+    """The response of a transaction did not arrive in time."""
+
+
+
+class SerialTransport:
+    """One serial port driven by an asyncio event loop."""
+
+    def __init__(self, port, baudrate=9600, terminator=b"\n", **serial_kwargs):
+        self.port = port
+        self.baudrate = baudrate
+        self.terminator = terminator
+        self.serial_kwargs = serial_kwargs
+        self.ser = None
+        self.buffer = bytearray()
+        self.queue = None
+        self.worker = None
+        self.data = None
+        self.loop = None
+
+    async def open(self):
+        """Open the port and start the worker task (on the running loop)."""
+        self.loop = asyncio.get_running_loop()
+        self.ser = serial.Serial(port=self.port, baudrate=self.baudrate, timeout=0,
+                                 **self.serial_kwargs)
+        self.queue = asyncio.Queue()
+        self.data = asyncio.Event()
+        self.loop.add_reader(self.ser.fileno(), self.on_readable)
+        self.worker = self.loop.create_task(self.serve())
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        if self.ser is not None:
+            self.loop.remove_reader(self.ser.fileno())
+            self.ser.close()
+            self.ser = None
+
+    async def transaction(self, command, lines=1, timeout=1.0):
+        """Queue command (bytes) and return the next lines response lines
+        (bytes, terminator included). Raises SerialTimeout if they do not
+        arrive within timeout seconds of the command being sent. Cancelling
+        the call removes a queued command or aborts the running one."""
+        future = self.loop.create_future()
+        await self.queue.put((command, lines, timeout, future))
+        return await future
+
+    def on_readable(self):
+        self.buffer += self.ser.read(self.ser.in_waiting or 1)
+        self.data.set()
+
+    async def readline(self):
+        while True:
+            end = self.buffer.find(self.terminator)
+            if end >= 0:
+                end += len(self.terminator)
+                line = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return line
+            self.data.clear()
+            await self.data.wait()
+
+    async def exchange(self, command, lines):
+        #drop anything left over from an earlier, interrupted transaction
+        self.ser.reset_input_buffer()
+        del self.buffer[:]
+        self.ser.write(command)
+        return [await self.readline() for i in range(lines)]
+
+    async def serve(self):
+        """Worker: run the queued transactions one at a time."""
+        while True:
+            command, lines, timeout, future = await self.queue.get()
+            if future.done():
+                #cancelled while queued
+                continue
+            exchange = self.loop.create_task(self.exchange(command, lines))
+            future.add_done_callback(lambda f, exchange=exchange: f.cancelled() and exchange.cancel())
+            try:
+                result = await asyncio.wait_for(exchange, timeout)
+            except asyncio.TimeoutError:
+                if not future.done():
+                    future.set_exception(SerialTimeout("Timeout after %.1f s waiting for the response to %r."
+                                                       %(timeout, command)))
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    #the worker itself is being cancelled
+                    raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def event_loop():
+    """The event loop of the shared background thread, started on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name="SerialTransport")
+            thread.daemon = True
+            thread.start()
+        return _loop
+
+
+
+class SyncSerialTransport:
+    """Blocking facade of a SerialTransport running on event_loop()."""
+
+    def __init__(self, port, **kwargs):
+        self.loop = event_loop()
+        self.transport = SerialTransport(port, **kwargs)
+        self.call(self.transport.open())
+
+    def call(self, coroutine, timeout=None):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise SerialTimeout("No result within %.1f s." %timeout)
+
+    def transaction(self, command, lines=1, timeout=1.0):
+        #the transport enforces the timeout once the command is sent; time
+        #spent queued behind other callers does not count
+        return self.call(self.transport.transaction(command, lines, timeout))
+
+    def close(self):
+        self.call(self.transport.close())
@@ -0,0 +1,201 @@
+#Latency benchmark of the Cornerstone control path against the simulated
+#controller (sim_cornerstone.py). With the default --time-scale 0 motions
+#complete at once and there are no serial transmission delays, so the
+#numbers are the software path: Mono, the serial link and the status polls.
+#Use --time-scale 1 for the timing of the real instrument.
+#
+#Operations, timed per call:
+#  query       Mono.get_wavelength
+#  shutter     Mono.open_shutter
+#  refresh     Mono.refresh (all four quantities, one status check)
+#  gowave      Mono.set_wavelength, start and wait for completion
+#  step        Mono.set_step
+#  tango_read  read of wavelength through a DeviceProxy (cached), --tango
+#  tango_move  write of wavelength until the device leaves MOVING, --tango
+#
+#Examples:
+#  python bench_monochromator.py --save before.json
+#  python bench_monochromator.py --save after.json --compare before.json
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy
+
+import lib_monochromator as lm
+import sim_cornerstone
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+
+OPERATIONS = ["query", "shutter", "refresh", "gowave", "step", "tango_read", "tango_move"]
+
+
+
+def summarize(samples):
+    """Statistics in microseconds of a list of durations in seconds."""
+    us = numpy.asarray(samples)*1e6
+    return {"n": len(us),
+            "median_us": float(numpy.median(us)),
+            "p95_us": float(numpy.percentile(us, 95)),
+            "mean_us": float(numpy.mean(us)),
+            "max_us": float(numpy.max(us))}
+
+
+def bench_mono(port, error_check, transport, repeat, warmup):
+    """Time the Mono operations for one error check policy and link."""
+    mono = lm.Mono(port, error_check=error_check, transport=bool(transport))
+    calls = {"query": mono.get_wavelength,
+             "shutter": mono.open_shutter,
+             "refresh": mono.refresh,
+             "gowave": lambda i: mono.set_wavelength(500 + 10*(i % 2)),
+             "step": lambda i: mono.set_step(10 if i % 2 else -10)}
+    samples = dict((name, []) for name in calls)
+    for name, call in calls.items():
+        for i in range(warmup + repeat):
+            t0 = clock()
+            if name in ("gowave", "step"):
+                call(i)
+            else:
+                call()
+            t1 = clock()
+            if i >= warmup:
+                samples[name].append(t1 - t0)
+    if mono.error_check == lm.CHECK_BATCH:
+        mono.check_errors()
+    if mono.port is not None:
+        mono.port.close()
+    else:
+        mono.ser.close()
+    return samples
+
+
+def bench_tango(port, error_check, transport, repeat, warmup):
+    """Time reads and moves of a device in a forked test server. Returns
+    None if PyTango or its test context is not available."""
+    try:
+        from PyTango import DevState
+        from PyTango.test_context import DeviceTestContext
+        from dev_monochromator import Cornerstone
+    except ImportError as e:
+        print("Skipping the Tango operations: %s" %e)
+        return None
+    samples = {"tango_read": [], "tango_move": []}
+    properties = {"serial_port": port, "refresh_interval": 0,
+                  "error_check": error_check, "serial_transport": bool(transport)}
+    with DeviceTestContext(Cornerstone, properties=properties, process=True) as proxy:
+        for i in range(warmup + repeat):
+            t0 = clock()
+            proxy.read_attribute("wavelength")
+            t1 = clock()
+            proxy.wavelength = 500 + 10*(i % 2)
+            while proxy.state() == DevState.MOVING:
+                time.sleep(0.001)
+            t2 = clock()
+            if i >= warmup:
+                samples["tango_read"].append(t1 - t0)
+                samples["tango_move"].append(t2 - t1)
+    return samples
+
+
+def environment():
+    """Versions and commit the results were measured with."""
+    try:
+        commit = subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        commit = commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ""
+    return {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "commit": commit,
+            "host": platform.node(),
+            "python": platform.python_version()}
+
+
+def config_key(result):
+    return (result["error_check"], result["transport"], result["time_scale"])
+
+
+def compare(results, baseline, tolerance):
+    """Print the median of every operation against the baseline. Returns the
+    number of operations slower than baseline by more than tolerance."""
+    reference = dict((config_key(result), result) for result in baseline["results"])
+    regressions = 0
+    print("\nCompared with %s (%s):" %(baseline["environment"].get("commit") or "baseline",
+                                       baseline["environment"].get("date", "")))
+    for result in results:
+        old = reference.get(config_key(result))
+        if old is None:
+            continue
+        for name, stats in sorted(result["operations"].items()):
+            if name not in old["operations"]:
+                continue
+            ratio = stats["median_us"]/max(old["operations"][name]["median_us"], 1e-3)
+            flag = ""
+            if ratio > 1 + tolerance:
+                flag = "  REGRESSION"
+                regressions += 1
+            print("  check=%-6s transport=%d %-10s %10.1f -> %10.1f us  x%.2f%s"
+                  %(result["error_check"], result["transport"], name,
+                    old["operations"][name]["median_us"], stats["median_us"], ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latency benchmark of the Cornerstone control path.")
+    parser.add_argument("--time-scale", type=float, default=0.0,
+                        help="factor on the simulated motion and transmission times (default 0)")
+    parser.add_argument("--error-check", default=",".join([lm.CHECK_ALWAYS, lm.CHECK_MOTION, lm.CHECK_BATCH]),
+                        help="comma separated error check policies to run")
+    parser.add_argument("--transport", default="0",
+                        help="comma separated: 0 for pyserial, 1 for lib_serialtransport")
+    parser.add_argument("--repeat", type=int, default=50, help="timed calls per operation")
+    parser.add_argument("--warmup", type=int, default=5, help="untimed calls per operation")
+    parser.add_argument("--tango", action="store_true",
+                        help="also time reads and moves through a Tango test server")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative slowdown reported as a regression (default 0.2)")
+    args = parser.parse_args(argv)
+
+    results = []
+    for error_check in args.error_check.split(","):
+        for transport in [int(value) for value in args.transport.split(",")]:
+            simulator = sim_cornerstone.SimulatedCornerstone(time_scale=args.time_scale)
+            try:
+                samples = bench_mono(simulator.port, error_check, transport, args.repeat, args.warmup)
+                if args.tango:
+                    samples.update(bench_tango(simulator.port, error_check, transport,
+                                               args.repeat, args.warmup) or {})
+            finally:
+                simulator.close()
+            operations = dict((name, summarize(values)) for name, values in samples.items())
+            results.append({"error_check": error_check, "transport": transport,
+                            "time_scale": args.time_scale, "operations": operations})
+            print("check=%-6s transport=%d  %s"
+                  %(error_check, transport,
+                    "  ".join("%s %.0f" %(name, operations[name]["median_us"])
+                              for name in OPERATIONS if name in operations)))
+
+    report = {"environment": environment(), "results": results}
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    regressions = 0
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,31 @@
+import asyncio
+import os
+import sys
+
 import numpy
 import PyTango
-from PyTango import DispLevel, AttrWriteType, DevState
+from PyTango import DispLevel, AttrWriteType, DevState, AttrQuality, GreenMode
 from PyTango.server import DeviceMeta, Device, server_run
 from PyTango.server import command, attribute, device_property
 
 import lib_monochromator as lm
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+import lib_instrumentation
+
 class Cornerstone(Device):
     __metaclass__ = DeviceMeta
+    #handlers run on an asyncio event loop; hardware calls are awaited in
+    #executor threads, so cached reads are answered while a call is in flight
+    green_mode = GreenMode.Asyncio
     #properties
     serial_port = device_property(dtype = str, default_value= "/dev/ttyUSB1")
+    refresh_interval = device_property(dtype = float, default_value = 5.0,
+                                       doc = "Seconds between background refreshes of the cached wavelength, grating, shutter and step (0 = only on Refresh).")
+    error_check = device_property(dtype = str, default_value = lm.CHECK_MOTION,
+                                  doc = "When the status byte is checked: always (after every command), motion (after motions only) or batch (only by CheckErrors and Refresh).")
+    serial_transport = device_property(dtype = bool, default_value = False,
+                                       doc = "Send the commands through the asyncio serial transport (lib_serialtransport) instead of pyserial directly.")
 
     #attributes
     wavelength = attribute(label = "Wavelength", unit ="nm",
@@ -35,13 +51,53 @@ class Cornerstone(Device):
                         dtype = int, access = AttrWriteType.READ_WRITE,
                         doc = "Shutter can be either open=1 or closed=0.")
 
-
-    def init_device(self):
-        Device.init_device(self)
+    #call statistics
+    CallStatistics = attribute(label = "Call statistics", unit = "",
+                               display_level=DispLevel.EXPERT,
+                               dtype=[str,],
+                               max_dim_x=lib_instrumentation.MAX_OPERATIONS, max_dim_y=0,
+                               access = AttrWriteType.READ,
+                               doc = "One line per serial command: calls, errors and mean, median, 99th percentile and maximum latency in micro seconds.")
+
+    CallCount = attribute(label = "Call count", unit = "calls",
+                          display_level=DispLevel.EXPERT,
+                          dtype = int, access = AttrWriteType.READ,
+                          doc = "Number of serial command calls since start or the last ResetCallStatistics.")
+
+    CallErrors = attribute(label = "Call errors", unit = "calls",
+                           display_level=DispLevel.EXPERT,
+                           dtype = int, access = AttrWriteType.READ,
+                           doc = "Number of serial command calls that raised an error.")
+
+    CallHistograms = attribute(label = "Call latency histograms", unit = "calls",
+                               display_level=DispLevel.EXPERT,
+                               dtype=((int,),),
+                               max_dim_x=lib_instrumentation.NUMBER_OF_BUCKETS,
+                               max_dim_y=lib_instrumentation.MAX_OPERATIONS,
+                               access = AttrWriteType.READ,
+                               doc = "Latency histogram of each serial command, one row per line of CallStatistics, buckets as in CallHistogramEdges.")
+
+    CallHistogramEdges = attribute(label = "Call histogram edges", unit = "micro seconds",
+                                   display_level=DispLevel.EXPERT,
+                                   dtype=[float,],
+                                   max_dim_x=lib_instrumentation.NUMBER_OF_BUCKETS, max_dim_y=0,
+                                   access = AttrWriteType.READ,
+                                   doc = "Upper latency limit of every CallHistograms bucket.")
+
+
+    #the handshake and the first refresh are awaited like any other
+    #hardware call, so an Init does not block the other clients
+    async def init_device(self):
+        await Device.init_device(self)
+        self.motion = None
         self.set_state(PyTango.DevState.INIT)
         self.set_status("Device in init!")
         try:
-            self.Mono = lm.Mono(serial_port=self.serial_port)
+            self.Mono = await self.hardware(lambda: lm.Mono(serial_port=self.serial_port,
+                                                            error_check=self.error_check,
+                                                            transport=self.serial_transport))
+            await self.hardware(self.Mono.refresh)
+            self.Mono.start_refresh(self.refresh_interval)
             self.set_state(PyTango.DevState.ON)
             self.set_status("Device is ON!")
             print("Device is now turned on")
@@ -56,14 +112,34 @@ class Cornerstone(Device):
     #    self.set_state(PyTango.DevState.OFF)
     #    self.set_status("Connection stopped. press init to reestablish.")
 
+    def delete_device(self):
+        if getattr(self, "Mono", None) is not None:
+            self.Mono.stop_refresh()
+
+    #run a (blocking) Mono call in an executor thread. Mono serialises the
+    #serial transactions itself.
+    async def hardware(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    #reads are answered from the state model of Mono
+    def read_cached(self, key):
+        if self.Mono.target is not None and self.Mono.target[0] == key:
+            quality = AttrQuality.ATTR_CHANGING
+        elif key in self.Mono.stale:
+            quality = AttrQuality.ATTR_INVALID
+        else:
+            quality = AttrQuality.ATTR_VALID
+        return self.Mono.state[key], self.Mono.state_time[key], quality
+
     def read_shutter(self):
-        return self.Mono.get_shutter()
+        return self.read_cached("shutter")
 
-    def write_shutter(self, n):
+    async def write_shutter(self, n):
+        self.check_not_moving()
         if n == 0:
-            self.Mono.close_shutter()
+            await self.hardware(self.Mono.close_shutter)
         elif n == 1:
-            self.Mono.open_shutter()
+            await self.hardware(self.Mono.open_shutter)
         else:
             raise ValueError
     # def open_shutter(self):
@@ -73,21 +149,97 @@ class Cornerstone(Device):
 
 
     def read_wavelength(self):
-        return self.Mono.get_wavelength()
-    def write_wavelength(self, wavelength):
-        self.Mono.set_wavelength(wavelength)
+        return self.read_cached("wavelength")
+    async def write_wavelength(self, wavelength):
+        await self.start_motion(self.Mono.start_wavelength, wavelength, "GOWAVE")
 
     def read_grating(self):
-        return self.Mono.get_grating()
-    def write_grating(self, n):
-        self.Mono.set_grating(n)
+        return self.read_cached("grating")
+    async def write_grating(self, n):
+        await self.start_motion(self.Mono.start_grating, n, "GRAT")
 
     def read_step(self):
-        return self.Mono.get_step()
-    def write_step(self, steps):
-        self.Mono.set_step(steps)
+        return self.read_cached("step")
+    async def write_step(self, steps):
+        self.check_not_moving()
+        await self.hardware(self.Mono.set_step, steps)
+
+    def read_CallStatistics(self):
+        return self.Mono.instrumentation.statistics()
+
+    def read_CallCount(self):
+        return self.Mono.instrumentation.totals()[0]
+
+    def read_CallErrors(self):
+        return self.Mono.instrumentation.totals()[1]
+
+    def read_CallHistograms(self):
+        histograms = numpy.array(self.Mono.instrumentation.histograms(), dtype=int)
+        return histograms.reshape(-1, lib_instrumentation.NUMBER_OF_BUCKETS)
+
+    def read_CallHistogramEdges(self):
+        return lib_instrumentation.bucket_edges()
+
+    @command
+    def ResetCallStatistics(self):
+        self.Mono.instrumentation.reset()
+
+    @command
+    async def Refresh(self):
+        """Read wavelength, grating, shutter and step from the hardware now."""
+        await self.hardware(self.Mono.refresh)
+
+    def is_Refresh_allowed(self):
+        return self.get_state() != DevState.MOVING
+
+    @command
+    async def CheckErrors(self):
+        """Check the status byte for errors of the commands not checked yet."""
+        await self.hardware(self.Mono.check_errors)
+
+    def is_CheckErrors_allowed(self):
+        return self.get_state() != DevState.MOVING
+
+    @command
+    async def Abort(self):
+        """Stop a wavelength motion immediately."""
+        await self.hardware(self.Mono.abort)
+
+    #motions: the write returns once the move has started, completion is
+    #awaited in a task while the device is MOVING
+    def check_not_moving(self):
+        #the controller answers no commands until the motion is done
+        if self.get_state() == DevState.MOVING:
+            raise RuntimeError("The monochromator is still moving.")
+
+    async def start_motion(self, start, value, keyword):
+        self.check_not_moving()
+        #MOVING before the first await, so concurrent writes are refused
+        state, status = self.get_state(), self.get_status()
+        self.set_state(DevState.MOVING)
+        self.set_status("Moving: %s %d" %(keyword, value))
+        try:
+            await self.hardware(start, value)
+        except Exception:
+            self.set_state(state)
+            self.set_status(status)
+            raise
+        self.motion = asyncio.ensure_future(self.finish_motion(keyword))
+
+    async def finish_motion(self, keyword):
+        try:
+            await self.hardware(self.Mono.wait_for_motion, lm.COMMAND_TIMEOUTS[keyword])
+            self.set_state(DevState.ON)
+            self.set_status("Device is ON!")
+        except Exception as e:
+            self.set_state(DevState.ALARM)
+            self.set_status("%s failed: %s" %(keyword, e))
 
 
 
 if __name__ == "__main__":
-    Cornerstone.run_server()
+    util = PyTango.Util(sys.argv)
+    #no device level lock around the handlers, so they can interleave on the
+    #event loop; Mono serialises the hardware access
+    util.set_serial_model(PyTango.SerialModel.NO_SYNC)
+    Cornerstone.run_server(util=util)
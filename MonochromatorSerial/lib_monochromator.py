@@ -1,19 +1,121 @@
+import contextlib
+import functools
+import os
+import sys
 import serial
+import threading
 import time
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+import lib_instrumentation
+
+
+#seconds to wait for the complete response of a command. Queries answer at
+#once; motion commands may only answer when the motion is done.
+DEFAULT_TIMEOUT = 1.0
+COMMAND_TIMEOUTS = {"GOWAVE": 15.0,
+                    "STEP": 15.0,
+                    "GRAT": 30.0,
+                    "SHUTTER": 2.0,
+                    "ABORT": 2.0}
+#status polling while a motion completes
+POLL_INTERVAL = 0.25
+POLL_TIMEOUT = 0.5
+#name of these polls in the call statistics
+POLL_OPERATION = "STB? (motion)"
+#quantities kept in the state model of Mono, and those a motion can change
+STATE_KEYS = ("wavelength", "grating", "shutter", "step")
+MOTION_KEYS = ("wavelength", "grating", "step")
+
+#error check policies: check the status byte after every command, only
+#after motions (GOWAVE, GRAT, STEP, ABORT), or only at the end of a batch
+#(see Mono.batch and Mono.check_errors)
+CHECK_ALWAYS = "always"
+CHECK_MOTION = "motion"
+CHECK_BATCH = "batch"
+
+#decoded ERROR? codes
+ERROR_MESSAGES = {0: "System error (miscellaneous).",
+                  1: "Command not understood.",
+                  2: "Bad parameter used in Command.",
+                  3: "Destination position for wavelength motion not allowed.",
+                  6: "Accessory not present (usually filter wheel).",
+                  7: "Accessory already in specified position.",
+                  8: "Could not home wavelength drive.",
+                  9: "Label too long."}
+
+
+
+class MonoError(Exception):
+    #error reported by the controller, with the decoded error code and the
+    #command(s) sent since the last check
+    def __init__(self, code, commands=None):
+        self.code = code
+        self.commands = commands
+        self.description = ERROR_MESSAGES.get(code, "Unknown error code: %s" %code)
+        after = " after %s" %commands if commands else ""
+        Exception.__init__(self, "Cornerstone error %s%s: %s" %(code, after, self.description))
+
+
+
+#name of command in the call statistics: the command without its numeric
+#arguments
+def operation_name(command):
+    return " ".join(word for word in command.split()
+                    if not word.lstrip("-").replace(".", "", 1).isdigit())
+
+
+#method decorator: hold Mono.lock for the whole call, so that a command and
+#its status check are not split by another thread's transactions
+def locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 
 class Mono:
-    #Constructor
-    def __init__(self, serial_port='/dev/ttyUSB0'):
-        self.ser = serial.Serial(port=serial_port,
-                                 baudrate=9600,
-                                 bytesize=8,
-                                 stopbits=1,
-                                 timeout=2,
-                                 parity=serial.PARITY_NONE)
-        self.ser.write("HANDSHAKE 0\n")
-        self.ser.readlines()
+    #Constructor. With transport the serial link goes through
+    #lib_serialtransport (Python 3): True opens a SyncSerialTransport on
+    #serial_port, or pass one already opened.
+    def __init__(self, serial_port='/dev/ttyUSB0', error_check=CHECK_ALWAYS, transport=None):
+        if error_check not in (CHECK_ALWAYS, CHECK_MOTION, CHECK_BATCH):
+            raise ValueError("Unknown error check policy %r." %error_check)
+        self.error_check = error_check
+        #commands whose check the policy deferred, shared by all threads, and
+        #those of the batch a thread is in (local.unchecked, None outside)
+        self.unchecked = []
+        self.local = threading.local()
+        #count and time every serial transaction, see transaction
+        self.instrumentation = lib_instrumentation.Instrumentation()
+        #one transaction at a time, also while a motion is polled from another thread
+        self.lock = threading.RLock()
+        #state model: last known value and time of every STATE_KEYS entry,
+        #updated by every successful read or write. Keys in stale may no
+        #longer match the hardware (after an error or a move).
+        self.state = dict((key, None) for key in STATE_KEYS)
+        self.state_time = dict((key, 0.0) for key in STATE_KEYS)
+        self.stale = set(STATE_KEYS)
+        self.moving = False
+        self.target = None
+        self.refresher = None
+        self.port = None
+        self.ser = None
+        if transport is True:
+            import lib_serialtransport
+            self.port = lib_serialtransport.SyncSerialTransport(serial_port, baudrate=9600)
+        elif transport:
+            self.port = transport
+        else:
+            self.ser = serial.Serial(port=serial_port,
+                                     baudrate=9600,
+                                     bytesize=8,
+                                     stopbits=1,
+                                     timeout=DEFAULT_TIMEOUT,
+                                     parity=serial.PARITY_NONE)
+        self.transaction("HANDSHAKE 0")
         self.error_checker()
 
 
@@ -23,113 +125,294 @@ class Mono:
     def read_buffer(self):
         return self.ser.readline()
 
+    #state model
+    def update_state(self, key, value):
+        self.state[key] = value
+        self.state_time[key] = time.time()
+        self.stale.discard(key)
+
+    #read the given quantities from the hardware into the state model
+    def refresh(self, keys=STATE_KEYS):
+        readers = {"wavelength": self.get_wavelength,
+                   "grating": self.get_grating,
+                   "shutter": self.get_shutter,
+                   "step": self.get_step}
+        with self.lock:
+            try:
+                #one status check for all the queries
+                with self.batch():
+                    for key in keys:
+                        readers[key]()
+            except Exception:
+                self.stale.update(STATE_KEYS)
+                raise
+
+    #refresh the state model every interval seconds in a background thread
+    #(not while moving); interval 0 stops it
+    def start_refresh(self, interval):
+        self.stop_refresh()
+        if interval > 0:
+            self.refresher = threading.Event()
+            thread = threading.Thread(target=self.refresh_loop, args=(interval, self.refresher),
+                                      name="CornerstoneRefresh")
+            thread.daemon = True
+            thread.start()
+
+    def stop_refresh(self):
+        if self.refresher is not None:
+            self.refresher.set()
+            self.refresher = None
+
+    def refresh_loop(self, interval, stopped):
+        while not stopped.wait(interval):
+            with self.lock:
+                if self.moving:
+                    continue
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print("Cornerstone state refresh failed: %r" %e)
+
+    #send a command and read its echo plus the given number of response
+    #lines. Returns as soon as they have arrived instead of waiting for the
+    #serial timeout; raises IOError if they do not arrive within timeout
+    #(default: COMMAND_TIMEOUTS of the command keyword).
+    #Every transaction is counted and timed in self.instrumentation, under
+    #the command without its numeric arguments (GOWAVE, SHUTTER O, STB?).
+    def transaction(self, command, lines=0, timeout=None):
+        with self.lock:
+            with self.instrumentation.timed(operation_name(command)):
+                return self._transaction(command, lines, timeout)
+
+    def _transaction(self, command, lines, timeout):
+        if timeout is None:
+            timeout = COMMAND_TIMEOUTS.get(command.split()[0], DEFAULT_TIMEOUT)
+        if self.port is not None:
+            response = [line.decode("ascii").strip() for line in
+                        self.port.transaction((command + "\n").encode("ascii"), lines + 1, timeout)]
+        else:
+            response = self.read_response(command, lines, timeout)
+        #the echo starts with the command keyword, anything else means the
+        #responses are out of step with the commands
+        echo = response[0]
+        if echo.split()[:1] != command.split()[:1]:
+            raise IOError("Unexpected echo %r of command %s." %(echo, command))
+        return response[1:]
+
+    #write command and read its echo and response lines with pyserial
+    def read_response(self, command, lines, timeout):
+        deadline = time.time() + timeout
+        #drop anything left over from an earlier, interrupted transaction
+        self.ser.flushInput()
+        self.ser.write((command + "\n").encode("ascii"))
+        response = []
+        partial = b""
+        while len(response) < lines + 1:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise IOError("Timeout after %.1f s waiting for the response to %s." %(timeout, command))
+            self.ser.timeout = remaining
+            partial += self.ser.readline()
+            if partial.endswith(b"\n"):
+                response.append(partial.decode("ascii").strip())
+                partial = b""
+        return response
+
+    #send a query and return its single response line
+    def query(self, command, timeout=None):
+        return self.transaction(command, 1, timeout)[0]
+
     #dealing with errors
+    #get the code of the last error
+    def get_error_code(self):
+        return int(self.query("ERROR?"))
     #get error messages
     def get_error_msg(self):
-        self.ser.write("ERROR?\n")
-        response = self.ser.readlines()
-        echo, errorcode_string = response
-        errorcode = int(errorcode_string[0:1])
-        if errorcode ==1:
-            error_msg = "Error message: Command not understood."
-        elif errorcode == 2:
-            error_msg = "Error message: Bad parameter used in Command."
-        elif errorcode == 3:
-            error_msg = "Error message: Destination position for wavelength motion not allowed."
-        elif errorcode == 6:
-            errormsg = "Error message: Accessory not present (usually filter wheel)."
-        elif errorcode == 7:
-            errormsg = "Error message: Accessory already in specified position."
-        elif errorcode == 8:
-            errormsg = "Error message: Could not home wavelength drive."
-        elif errorcode == 9:
-            errormsg = "Error message: Label too long."
-        elif errorcode == 0:
-            errormsg = "Error message: System error (miscellaneous)."
-        else:
-            error_msg = "Error message: Unknown error code: %s" %errorcode
-        return error_msg
+        return "Error message: " + MonoError(self.get_error_code()).description
     #Get status byte
-    def get_STB(self):
-        self.ser.write("STB?\n")
-        response = self.ser.readlines()
-        echo, STB_string = response
-        STB = int(STB_string[0:1])
-        return STB
-    #check for errors
-    def error_checker(self):
+    def get_STB(self, timeout=None):
+        return int(self.query("STB?", timeout))
+    #status byte poll of wait_for_motion, timed as POLL_OPERATION. The
+    #controller does not answer while it moves, so a timeout is expected and
+    #not counted as an error.
+    def poll_STB(self):
+        with self.lock:
+            start = lib_instrumentation.clock()
+            error = False
+            try:
+                return int(self._transaction("STB?", 1, POLL_TIMEOUT)[0])
+            except IOError:
+                raise
+            except Exception:
+                error = True
+                raise
+            finally:
+                self.instrumentation.record(POLL_OPERATION, lib_instrumentation.clock() - start, error)
+    #check for errors, raises MonoError
+    @locked
+    def error_checker(self, commands=None):
         STB = self.get_STB()
         if STB == 0:
             return 0
         else:
-            print(self.get_error_msg())
-            raise Exception
+            self.stale.update(STATE_KEYS)
+            raise MonoError(self.get_error_code(), commands)
+
+    #check for errors after command as the error check policy says, or
+    #remember it for the next check_errors
+    def check(self, command, motion=False):
+        batch = getattr(self.local, "unchecked", None)
+        if batch is not None:
+            batch.append(command)
+            del batch[:-16]
+            return
+        if self.error_check == CHECK_BATCH or (self.error_check == CHECK_MOTION and not motion):
+            with self.lock:
+                self.unchecked.append(command)
+                #only the latest commands are named in the error
+                del self.unchecked[:-16]
+            return
+        self.check_errors(command)
+
+    #check for errors of all commands not checked yet (and command)
+    @locked
+    def check_errors(self, command=None):
+        commands, self.unchecked = self.unchecked, []
+        if command is not None:
+            commands.append(command)
+        self.error_checker(", ".join(commands))
+
+    #defer the error checks of the commands in the with block to a single
+    #check at its end:
+    #    with mono.batch():
+    #        mono.open_shutter()
+    #        mono.set_wavelength(500)
+    #The batch only covers the commands of the calling thread.
+    @contextlib.contextmanager
+    def batch(self):
+        outer = getattr(self.local, "unchecked", None) is None
+        if outer:
+            self.local.unchecked = []
+        try:
+            yield self
+        finally:
+            if outer:
+                commands, self.local.unchecked = self.local.unchecked, None
+        if outer and (commands or self.unchecked):
+            with self.lock:
+                self.unchecked.extend(commands)
+                del self.unchecked[:-16]
+                self.check_errors()
+
+    #start a motion to the target (key, value), see wait_for_motion
+    def start_motion(self, command, key, value):
+        with self.lock:
+            self.moving = True
+            self.target = (key, value)
+            self.stale.add(key)
+            try:
+                self.transaction(command)
+            except Exception:
+                self.moving = False
+                raise
+
+    #wait until a motion has completed and check for errors. The controller
+    #answers no queries while it moves, so the motion is done when a status
+    #byte query is answered again. The position is then read back from the
+    #hardware: the motion may have been aborted or interrupted short of the
+    #target.
+    def wait_for_motion(self, timeout):
+        deadline = time.time() + timeout
+        try:
+            while True:
+                try:
+                    with self.lock:
+                        #the status byte polled is the error check of the motion
+                        if self.poll_STB() != 0:
+                            self.stale.update(STATE_KEYS)
+                            raise MonoError(self.get_error_code(), self.target and "%s %s" %self.target)
+                    break
+                except IOError:
+                    if time.time() > deadline:
+                        self.stale.update(STATE_KEYS)
+                        raise IOError("Motion did not complete within %.0f s." %timeout)
+                    time.sleep(POLL_INTERVAL)
+            self.refresh(MOTION_KEYS)
+        finally:
+            self.moving = False
+            self.target = None
 
     #get and set wavelength
+    #start_wavelength returns as soon as the move has started, see wait_for_motion
+    def start_wavelength(self, wavelength):
+        self.start_motion("GOWAVE %d" %wavelength, "wavelength", int(wavelength))
     def set_wavelength(self, wavelength):
-        self.ser.write("GOWAVE %d\n" %wavelength)
-        response = self.ser.readlines()
-        self.error_checker()
+        self.start_wavelength(wavelength)
+        self.wait_for_motion(COMMAND_TIMEOUTS["GOWAVE"])
+    @locked
     def get_wavelength(self):
-        self.ser.write("WAVE?\n")
-        response = self.ser.readlines()
-        echo, wavelength = response
-        wavelength = float(wavelength[0:7])
-        self.error_checker()
+        wavelength = float(self.query("WAVE?"))
+        self.check("WAVE?")
+        self.update_state("wavelength", int(wavelength))
         return int(wavelength)
 
     #stop any wavelength adjustment immediately
+    @locked
     def abort(self):
-        self.ser.write('ABORT\n')
-        response = self.ser.readlines()
-        self.error_checker()
+        self.stale.add("wavelength")
+        self.transaction("ABORT")
+        self.check("ABORT", motion=True)
 
     #change the wavelength by some steps between -9999 and 9999
+    @locked
     def set_step(self, n):
-        self.ser.write("STEP %d\n" %n)
-        response = self.ser.readlines()
-        self.error_checker()
+        self.stale.update(("step", "wavelength"))
+        self.transaction("STEP %d" %n)
+        self.check("STEP %d" %n, motion=True)
+        self.refresh(("step", "wavelength"))
+    @locked
     def get_step(self):
-        self.ser.write("STEP?\n")
-        response = self.ser.readlines()
-        echo, step = response
-        step = int(step[0:4])
-        self.error_checker()
+        step = int(self.query("STEP?"))
+        self.check("STEP?")
+        self.update_state("step", step)
         return step
 
     #shutter control
+    @locked
     def close_shutter(self):
-        self.ser.write("SHUTTER C\n")
-        response = self.ser.readlines()
-        self.error_checker()
+        self.transaction("SHUTTER C")
+        self.check("SHUTTER C")
+        self.update_state("shutter", 0)
+    @locked
     def open_shutter(self):
-        self.ser.write("SHUTTER O\n")
-        response = self.ser.readlines()
-        self.error_checker()
+        self.transaction("SHUTTER O")
+        self.check("SHUTTER O")
+        self.update_state("shutter", 1)
+    @locked
     def get_shutter(self):
-        self.ser.write("SHUTTER?\n")
-        response = self.ser.readlines()
-        echo, shutter = response
-        shutter = shutter[0]
-        self.error_checker()
+        shutter = self.query("SHUTTER?")[0]
+        self.check("SHUTTER?")
         if shutter == 'O':
+            self.update_state("shutter", 1)
             return 1
         elif shutter == 'C':
+            self.update_state("shutter", 0)
             return 0
 
 
     #Switch between grating number one and two
+    #start_grating returns as soon as the turret has started to turn (about
+    #12 s), see wait_for_motion
+    def start_grating(self, grating_number):
+        self.start_motion("GRAT %d" %grating_number, "grating", int(grating_number))
     def set_grating(self, grating_number):
-        self.ser.write("GRAT %d\n" %grating_number)
-        time.sleep(12)
-        response = self.ser.readlines()
-        self.error_checker()
+        self.start_grating(grating_number)
+        self.wait_for_motion(COMMAND_TIMEOUTS["GRAT"])
+    @locked
     def get_grating(self):
-        self.ser.write("GRAT?\n")
-        response = self.ser.readlines()
-        echo, grating_number = response
-        grating_number = int(grating_number[0])
-        self.error_checker()
+        grating_number = int(self.query("GRAT?")[0])
+        self.check("GRAT?")
+        self.update_state("grating", grating_number)
         return grating_number
 
 
@@ -0,0 +1,228 @@
+#Simulated Cornerstone monochromator on a pseudo-terminal. It speaks the
+#subset of the command set lib_monochromator uses (HANDSHAKE, GOWAVE, WAVE?,
+#STEP, STEP?, ABORT, SHUTTER, SHUTTER?, GRAT, GRAT?, STB?, ERROR?) with an
+#echo of every command followed by its response lines, and models motion
+#and grating change times and the controller error codes, so Mono and the
+#Cornerstone device run against it on any Linux box:
+#
+#    python sim_cornerstone.py --time-scale 0.1
+#    Simulated Cornerstone on /dev/pts/5
+#
+#and use /dev/pts/5 as the serial_port of Mono or the device. While it moves
+#the controller only acts on ABORT; of the other commands received meanwhile
+#it keeps the last one and answers it when the motion is done.
+
+import argparse
+import os
+import select
+import threading
+import time
+import tty
+
+
+#status byte bit set while an error is pending (cleared by ERROR?)
+STB_ERROR = 0x20
+#error codes, see lib_monochromator.ERROR_MESSAGES
+ERROR_COMMAND = 1
+ERROR_PARAMETER = 2
+ERROR_DESTINATION = 3
+
+
+
+class SimulatedCornerstone:
+    """Cornerstone model served on the slave side of a pty (see port).
+
+    Durations are multiplied by time_scale; 0 makes motions complete at once
+    and drops the serial transmission delays, leaving the software path."""
+
+    def __init__(self, wavelength=500.0, grating=1, time_scale=1.0,
+                 slew_rate=200.0, settle_time=0.1, grating_time=12.0,
+                 nm_per_step=0.01, min_wavelength=0.0, max_wavelength=1600.0,
+                 gratings=((1200, "500NM"), (600, "1000NM")), baudrate=9600):
+        self.wavelength = float(wavelength)
+        self.grating = grating
+        self.shutter = "C"
+        self.time_scale = time_scale
+        self.slew_rate = slew_rate
+        self.settle_time = settle_time
+        self.grating_time = grating_time
+        self.nm_per_step = nm_per_step
+        self.min_wavelength = min_wavelength
+        self.max_wavelength = max_wavelength
+        self.gratings = gratings
+        self.baudrate = baudrate
+        self.error = None
+        self.handshake = 0
+        #current motion: (start time, end time, start wavelength, target wavelength)
+        self.motion = None
+        self.pending = None
+        self.commands = 0
+        self.dropped = 0
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.serve, name="SimulatedCornerstone")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def inject_error(self, code):
+        """Raise error code as if the last command had failed."""
+        self.error = code
+
+    #motion model
+    def moving(self):
+        self.update()
+        return self.motion is not None
+
+    def update(self):
+        #finish a motion whose end time has passed
+        if self.motion is not None and time.time() >= self.motion[1]:
+            self.wavelength = self.motion[3]
+            self.motion = None
+
+    def current_wavelength(self):
+        if self.motion is None:
+            return self.wavelength
+        start, end, origin, target = self.motion
+        fraction = min(1.0, (time.time() - start)/max(end - start, 1e-9))
+        return origin + (target - origin)*fraction
+
+    def start_motion(self, target, extra_time=0.0):
+        duration = self.settle_time + abs(target - self.wavelength)/self.slew_rate + extra_time
+        now = time.time()
+        self.motion = (now, now + duration*self.time_scale, self.wavelength, target)
+
+    #serial side
+    def serve(self):
+        buffer = b""
+        while not self.stopped.is_set():
+            timeout = 0.1
+            if self.motion is not None:
+                #wake up when the motion ends to answer the pending command
+                timeout = max(0.0, min(timeout, self.motion[1] - time.time()))
+            readable = select.select([self.master], [], [], timeout)[0]
+            if readable:
+                try:
+                    buffer += os.read(self.master, 1024)
+                except OSError:
+                    return
+            while b"\n" in buffer or b"\r" in buffer:
+                end = min(i for i in (buffer.find(b"\n"), buffer.find(b"\r")) if i >= 0)
+                line, buffer = buffer[:end], buffer[end + 1:]
+                line = line.decode("ascii", "replace").strip()
+                if line:
+                    self.receive(line)
+            if self.pending is not None and not self.moving():
+                line, self.pending = self.pending, None
+                self.reply(line)
+
+    def receive(self, line):
+        if not self.moving() or line.split()[0].upper() == "ABORT":
+            self.reply(line)
+            return
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = line
+
+    def reply(self, line):
+        self.commands += 1
+        response = self.execute(line)
+        self.send([line] + response)
+
+    def send(self, lines):
+        data = "".join(line + "\r\n" for line in lines).encode("ascii")
+        if self.time_scale:
+            #10 bits per character on the wire
+            time.sleep(len(data)*10.0/self.baudrate*self.time_scale)
+        os.write(self.master, data)
+
+    #command set
+    def execute(self, line):
+        """Apply one command and return its response lines (without echo)."""
+        fields = line.split()
+        keyword, args = fields[0].upper(), fields[1:]
+        try:
+            if keyword == "HANDSHAKE":
+                self.handshake = int(args[0])
+            elif keyword == "GOWAVE":
+                target = float(args[0])
+                if not self.min_wavelength <= target <= self.max_wavelength:
+                    self.error = ERROR_DESTINATION
+                else:
+                    self.start_motion(target)
+            elif keyword == "WAVE?":
+                return ["%.3f" %self.current_wavelength()]
+            elif keyword == "STEP":
+                steps = int(args[0])
+                if not -9999 <= steps <= 9999:
+                    raise ValueError(steps)
+                target = self.wavelength + steps*self.nm_per_step
+                if not self.min_wavelength <= target <= self.max_wavelength:
+                    self.error = ERROR_DESTINATION
+                else:
+                    self.start_motion(target)
+            elif keyword == "STEP?":
+                return ["%d" %int(round(self.current_wavelength()/self.nm_per_step))]
+            elif keyword == "ABORT":
+                if self.motion is not None:
+                    self.wavelength = self.current_wavelength()
+                    self.motion = None
+            elif keyword == "SHUTTER":
+                if args[0].upper() not in ("O", "C"):
+                    raise ValueError(args[0])
+                self.shutter = args[0].upper()
+            elif keyword == "SHUTTER?":
+                return [self.shutter]
+            elif keyword == "GRAT":
+                grating = int(args[0])
+                if not 1 <= grating <= len(self.gratings):
+                    raise ValueError(grating)
+                if grating != self.grating:
+                    self.grating = grating
+                    #the turret turns, then the drive returns to the wavelength
+                    self.start_motion(self.wavelength, self.grating_time)
+            elif keyword == "GRAT?":
+                lines, blaze = self.gratings[self.grating - 1]
+                return ["%d,%d,%s" %(self.grating, lines, blaze)]
+            elif keyword == "STB?":
+                return ["%d" %(STB_ERROR if self.error is not None else 0)]
+            elif keyword == "ERROR?":
+                code, self.error = self.error, None
+                return ["%d" %(code or 0)]
+            else:
+                self.error = ERROR_COMMAND
+        except (IndexError, ValueError):
+            self.error = ERROR_PARAMETER
+        return []
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulated Cornerstone monochromator on a pty.")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="factor on all motion and transmission times (0 = instant)")
+    parser.add_argument("--slew-rate", type=float, default=200.0, help="nm/s")
+    parser.add_argument("--grating-time", type=float, default=12.0, help="s per grating change")
+    parser.add_argument("--wavelength", type=float, default=500.0, help="initial wavelength (nm)")
+    args = parser.parse_args(argv)
+    simulator = SimulatedCornerstone(wavelength=args.wavelength, time_scale=args.time_scale,
+                                     slew_rate=args.slew_rate, grating_time=args.grating_time)
+    print("Simulated Cornerstone on %s" %simulator.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    simulator.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+from PyTango.server import server_run
+
+from dev_OceanOptics import OceanOpticsSpectrometer
+from dev_HR4000 import HR4000
+from dev_QE65000 import QE65000
+
+#Serve every Ocean Optics spectrometer from one process, so the USB bus is
+#enumerated by the shared OmniDriver session, again only for a spectrometer
+#it has not found yet. Register one device per
+#spectrometer (of class HR4000, QE65000 or OceanOpticsSpectrometer with the
+#serial_port property set) under this server instance. Each device runs its
+#own acquisition thread.
+if __name__ == "__main__":
+    server_run((OceanOpticsSpectrometer, HR4000, QE65000))
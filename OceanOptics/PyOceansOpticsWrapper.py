@@ -3,6 +3,7 @@
 # * Date: 2013-06-19
 # * Description: Python wrapper class for the OMNIDRIVER of OceansOptics
 # * Dependencies: OmniDriver64.dll and common64.dll 
+# *               (or sim_omnidriver.py with OMNIDRIVER_BACKEND=sim)
 # * Copyright (C) 2013 by Dr. Sylvio Haas.  All rights reserved.
 # */
 
@@ -12,15 +13,99 @@ import numpy as np
 import sys
 import os
 import time
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+import lib_instrumentation
+
+
+# default locations of the OmniDriver libraries; OMNIDRIVER_BACKEND selects another
+# library path or 'sim' for the simulator in sim_omnidriver.py, and
+# OMNIDRIVER_COEFFICIENTS_LIBRARY another library for the calibration coefficients
+DEFAULT_WRAPPER_LIBRARY = './libw.so'
+DEFAULT_COEFFICIENTS_LIBRARY = '/home/tango-cs/OmniDriverSPAM/OOI_HOME/libOmniDriver.so'
+
+
+# ctypes prototypes of the exported OmniDriver functions: name -> (restype, argtypes).
+# All OmniDriver objects (wrapper, coefficients, JString, DoubleArray) are opaque
+# handles and are declared as c_void_p so they are not truncated on 64-bit hosts.
+COEFFICIENTS_PROTOTYPES = {
+    'Coefficients_Create': (c_void_p, []),
+}
+for _name, _type in [('NlCoef0', c_double), ('NlCoef1', c_double),
+                     ('NlCoef2', c_double), ('NlCoef3', c_double),
+                     ('NlCoef4', c_double), ('NlCoef5', c_double),
+                     ('NlCoef6', c_double), ('NlCoef7', c_double),
+                     ('NlOrder', c_int), ('WlIntercept', c_double),
+                     ('WlFirst', c_double), ('WlSecond', c_double),
+                     ('WlThird', c_double), ('StrayLight', c_double)]:
+    COEFFICIENTS_PROTOTYPES['Coefficients_get' + _name] = (_type, [c_void_p])
+    COEFFICIENTS_PROTOTYPES['Coefficients_set' + _name] = (None, [c_void_p, _type])
+
+WRAPPER_PROTOTYPES = {
+    'Wrapper_Create': (c_void_p, []),
+    'Wrapper_openAllSpectrometers': (c_int, [c_void_p]),
+    'Wrapper_closeSpectrometer': (None, [c_void_p, c_int]),
+    'Wrapper_getCalibrationCoefficientsFromBuffer': (None, [c_void_p, c_int, c_void_p]),
+    'Wrapper_getSerialNumber': (None, [c_void_p, c_int, c_void_p]),
+    'Wrapper_getName': (None, [c_void_p, c_int, c_void_p]),
+    'Wrapper_getFirmwareVersion': (None, [c_void_p, c_int, c_void_p]),
+    'Wrapper_getWavelengths': (None, [c_void_p, c_int, c_void_p]),
+    'Wrapper_getSpectrum': (None, [c_void_p, c_int, c_void_p]),
+    'Wrapper_getNumberOfPixels': (c_int, [c_void_p, c_int]),
+    'Wrapper_getCorrectForElectricalDark': (c_short, [c_void_p, c_int]),
+    'Wrapper_setCorrectForElectricalDark': (None, [c_void_p, c_int, c_int]),
+    'Wrapper_getCorrectForStrayLight': (c_short, [c_void_p, c_int]),
+    'Wrapper_getCorrectForDetectorNonlinearity': (c_short, [c_void_p, c_int]),
+    'Wrapper_setCorrectForDetectorNonlinearity': (None, [c_void_p, c_int, c_int]),
+    'Wrapper_getIntegrationTime': (c_int, [c_void_p, c_int]),
+    'Wrapper_setIntegrationTime': (None, [c_void_p, c_int, c_int]),
+    'Wrapper_getScansToAverage': (c_int, [c_void_p, c_int]),
+    'Wrapper_setScansToAverage': (None, [c_void_p, c_int, c_int]),
+    'Wrapper_getMinimumIntegrationTime': (c_int, [c_void_p, c_int]),
+    'Wrapper_getMaximumIntegrationTime': (c_int, [c_void_p, c_int]),
+    'Wrapper_getMaximumIntensity': (c_int, [c_void_p, c_int]),
+    'Wrapper_isSaturated': (c_short, [c_void_p, c_int]),
+    'Wrapper_isTimeout': (c_short, [c_void_p, c_int]),
+    'Wrapper_setTimeout': (c_int, [c_void_p, c_int, c_int]),
+    'Wrapper_isSpectrumValid': (c_short, [c_void_p, c_int]),
+    'Wrapper_stopAveraging': (None, [c_void_p, c_int]),
+    'Wrapper_flushSpectrum': (c_short, [c_void_p, c_int]),
+}
+
+COMMON_PROTOTYPES = {
+    'JString_Create': (c_void_p, []),
+    'JString_getASCII': (c_char_p, [c_void_p]),
+    'DoubleArray_Create': (c_void_p, []),
+    'DoubleArray_getDoubleValues': (POINTER(c_double), [c_void_p]),
+}
+
+
+class DllFunctions:
+    """Table of library functions with their ctypes prototypes declared once."""
+
+    def __init__(self, lib, prototypes):
+        """Constructor.
+        @param lib loaded library object, or a python object with the same functions (simulator)
+        @param prototypes dictionary name -> (restype, argtypes)
+        """
+        for name, (restype, argtypes) in prototypes.items():
+            function = getattr(lib, name)
+            if isinstance(lib, CDLL):
+                function.restype = restype
+                function.argtypes = argtypes
+            setattr(self, name, function)
+
 
 class OceansOpticsCoefficientsWrapper:
     """Wrapper class to the coefficient datatype of the OO dll."""
     
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, lib=None):
         """Constructor.
         @param parent parent widget of this class (default: None)
+        @param lib library object to use (default: None == load DEFAULT_COEFFICIENTS_LIBRARY)
         """
-        self.__loadLibraries()          # load libraries
+        self.__loadLibraries(lib)       # load libraries
         self.__redirectDllOutput()      # redirect stdout and stderr
         self.__createDllDataTypes()     # create datatypes in python 
         
@@ -28,120 +113,112 @@ class OceansOpticsCoefficientsWrapper:
         """Public method: get nonlinearity coefficient 0.
         @return value (double)
         """
-        self.libOmniDriver.Coefficients_getNlCoef0.restype = c_double
-        return self.libOmniDriver.Coefficients_getNlCoef0(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getNlCoef0(self.dllCoefficients)
     
     def SetNlCoef0(self, value):
         """Public method: set nonlinearity coefficient 0.
         @param value nonlinearity coefficient 0
         @return none
         """
-        self.libOmniDriver.Coefficients_setNlCoef0(self.dllCoefficients, c_double(value))
+        self.fnOmniDriver.Coefficients_setNlCoef0(self.dllCoefficients, value)
         return None
     
     def GetNlCoef1(self):
         """Public method: get nonlinearity coefficient 1.
         @return value (double)
         """
-        self.libOmniDriver.Coefficients_getNlCoef1.restype = c_double
-        return self.libOmniDriver.Coefficients_getNlCoef1(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getNlCoef1(self.dllCoefficients)
     
     def SetNlCoef1(self, value):
         """Public method: set nonlinearity coefficient 1.
         @param value nonlinearity coefficient 1
         @return none
         """
-        self.libOmniDriver.Coefficients_setNlCoef1(self.dllCoefficients, c_double(value))
+        self.fnOmniDriver.Coefficients_setNlCoef1(self.dllCoefficients, value)
         return None
     
     def GetNlCoef2(self):
         """Public method: get nonlinearity coefficient 2.
         @return value (double)
         """
-        self.libOmniDriver.Coefficients_getNlCoef2.restype = c_double
-        return self.libOmniDriver.Coefficients_getNlCoef2(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getNlCoef2(self.dllCoefficients)
 
     def SetNlCoef2(self, value):
         """Public method: set nonlinearity coefficient 2.
         @param value nonlinearity coefficient 2
         @return none
         """
-        self.libOmniDriver.Coefficients_setNlCoef2(self.dllCoefficients, c_double(value))
+        self.fnOmniDriver.Coefficients_setNlCoef2(self.dllCoefficients, value)
         return None
 
     def GetNlCoef3(self):
         """Public method: get nonlinearity coefficient 3.
         @return value (double)
         """
-        self.libOmniDriver.Coefficients_getNlCoef3.restype = c_double
-        return self.libOmniDriver.Coefficients_getNlCoef3(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getNlCoef3(self.dllCoefficients)
     
     def SetNlCoef3(self, value):
         """Public method: set nonlinearity coefficient 3.
         @param value nonlinearity coefficient 3
         @return none
         """
-        self.libOmniDriver.Coefficients_setNlCoef3(self.dllCoefficients, c_double(value))
+        self.fnOmniDriver.Coefficients_setNlCoef3(self.dllCoefficients, value)
         return None
     
     def GetNlCoef4(self):
         """Public method: get nonlinearity coefficient 4.
         @return value (double)
         """
-        self.libOmniDriver.Coefficients_getNlCoef4.restype = c_double
-        return self.libOmniDriver.Coefficients_getNlCoef4(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getNlCoef4(self.dllCoefficients)
   
     def SetNlCoef4(self, value):
         """Public method: set nonlinearity coefficient 4.
         @param value nonlinearity coefficient 4
         @return none
         """
-        self.libOmniDriver.Coefficients_setNlCoef4(self.dllCoefficients, c_double(value))
+        self.fnOmniDriver.Coefficients_setNlCoef4(self.dllCoefficients, value)
         return None
    
     def GetNlCoef5(self):
         """Public method: get nonlinearity coefficient 5.
         @return value (double)
         """
-        self.libOmniDriver.Coefficients_getNlCoef5.restype = c_double
-        return self.libOmniDriver.Coefficients_getNlCoef5(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getNlCoef5(self.dllCoefficients)
     
     def SetNlCoef5(self, value):
         """Public method: set nonlinearity coefficient 5.
         @param value nonlinearity coefficient 5
         @return none
         """
-        self.libOmniDriver.Coefficients_setNlCoef5(self.dllCoefficients, c_double(value))
+        self.fnOmniDriver.Coefficients_setNlCoef5(self.dllCoefficients, value)
         return None
     
     def GetNlCoef6(self):
         """Public method: get nonlinearity coefficient 6.
         @return value (double)
         """
-        self.libOmniDriver.Coefficients_getNlCoef6.restype = c_double
-        return self.libOmniDriver.Coefficients_getNlCoef6(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getNlCoef6(self.dllCoefficients)
     
     def SetNlCoef6(self, value):
         """Public method: set nonlinearity coefficient 6.
         @param value nonlinearity coefficient 6
         @return none
         """
-        self.libOmniDriver.Coefficients_setNlCoef6(self.dllCoefficients, c_double(value))
+        self.fnOmniDriver.Coefficients_setNlCoef6(self.dllCoefficients, value)
         return None
     
     def GetNlCoef7(self):
         """Public method: get nonlinearity coefficient 7.
         @return value (double)
         """
-        self.libOmniDriver.Coefficients_getNlCoef7.restype = c_double
-        return self.libOmniDriver.Coefficients_getNlCoef7(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getNlCoef7(self.dllCoefficients)
     
     def SetNlCoef7(self, value):
         """Public method: set nonlinearity coefficient 7.
         @param value nonlinearity coefficient 7
         @return none
         """
-        self.libOmniDriver.Coefficients_setNlCoef7(self.dllCoefficients, c_double(value))
+        self.fnOmniDriver.Coefficients_setNlCoef7(self.dllCoefficients, value)
         return None
     
     def GetNlCoef(self):
@@ -179,75 +256,70 @@ class OceansOpticsCoefficientsWrapper:
         """Public method: get nonlinearity polynom order.
         @return polynom order (int)
         """
-        self.libOmniDriver.Coefficients_getNlOrder.restype = c_int
-        return self.libOmniDriver.Coefficients_getNlOrder(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getNlOrder(self.dllCoefficients)
 
     def SetNlOrder(self, value):
         """Public method: set nonlinearity polynom order.
         @param value polynom order (1-7)
         @return none
         """
-        self.libOmniDriver.Coefficients_setNlOrder(self.dllCoefficients, c_int(value))
+        self.fnOmniDriver.Coefficients_setNlOrder(self.dllCoefficients, value)
         return None
 
     def GetWlIntercept(self):
         """Public method: get wavelength intercept.
         @return wavelength intercept (double)
         """
-        self.libOmniDriver.Coefficients_getWlIntercept.restype = c_double
-        return self.libOmniDriver.Coefficients_getWlIntercept(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getWlIntercept(self.dllCoefficients)
     
     def SetWlIntercept(self, value):
         """Public method: set wavelength intercept.
         @param value wavelength intercept
         @return none
         """
-        self.libOmniDriver.Coefficients_setWlIntercept(self.dllCoefficients, c_double(value))
+        self.fnOmniDriver.Coefficients_setWlIntercept(self.dllCoefficients, value)
         return None
     
     def GetWlFirst(self):
         """Public method: get wavelength first order coefficient.
         @return wavelength first coef (double)
         """
-        self.libOmniDriver.Coefficients_getWlFirst.restype = c_double
-        return self.libOmniDriver.Coefficients_getWlFirst(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getWlFirst(self.dllCoefficients)
 
     def SetWlFirst(self, value):
         """Public method: set wavelength first order coefficient.
         @param value wavelength first order coefficient
         @return none
         """
-        self.libOmniDriver.Coefficients_setWlFirst(self.dllCoefficients, c_double(value))
+        self.fnOmniDriver.Coefficients_setWlFirst(self.dllCoefficients, value)
         return None
     
     def GetWlSecond(self):
         """Public method: get wavelength second order coefficient.
         @return wavelength second coef (double)
         """
-        self.libOmniDriver.Coefficients_getWlSecond.restype = c_double
-        return self.libOmniDriver.Coefficients_getWlSecond(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getWlSecond(self.dllCoefficients)
 
     def SetWlSecond(self, value):
         """Public method: set wavelength second order coefficient.
         @param value wavelength second order coefficient
         @return none
         """
-        self.libOmniDriver.Coefficients_setWlSecond(self.dllCoefficients, c_double(value))
+        self.fnOmniDriver.Coefficients_setWlSecond(self.dllCoefficients, value)
         return None
     
     def GetWlThird(self):
         """Public method: get wavelength third order coefficient.
         @return wavelength third coef (double)
         """
-        self.libOmniDriver.Coefficients_getWlThird.restype = c_double
-        return self.libOmniDriver.Coefficients_getWlThird(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getWlThird(self.dllCoefficients)
     
     def SetWlThird(self, value):
         """Public method: set wavelength third order coefficient.
         @param value wavelength third order coefficient
         @return none
         """
-        self.libOmniDriver.Coefficients_setWlThird(self.dllCoefficients, c_double(value))
+        self.fnOmniDriver.Coefficients_setWlThird(self.dllCoefficients, value)
         return None
     
     def GetWlCoef(self):
@@ -277,29 +349,51 @@ class OceansOpticsCoefficientsWrapper:
         """Public method: get stray light value.
         @return stray light value (double)
         """
-        self.libOmniDriver.Coefficients_getStrayLight.restype = c_double
-        return self.libOmniDriver.Coefficients_getStrayLight(self.dllCoefficients)
+        return self.fnOmniDriver.Coefficients_getStrayLight(self.dllCoefficients)
     
     def SetStrayLight(self, value):
         """Public method: set stray light coefficient.
         @param value Stray light coefficient
         @return none
         """
-        self.libOmniDriver.Coefficients_setStrayLight(self.dllCoefficients, c_double(value))
+        self.fnOmniDriver.Coefficients_setStrayLight(self.dllCoefficients, value)
         return None
     
+    def Snapshot(self):
+        """Public method: read all calibration coefficients in one pass.
+        Only the first NlOrder+1 nonlinearity coefficients are kept.
+        @return dictionary with nl_coef (numpy array), nl_order (int), wl_coef (numpy array length 4) and stray_light (float)
+        """
+        fn = self.fnOmniDriver
+        coefficients = self.dllCoefficients
+        nlOrder = int(fn.Coefficients_getNlOrder(coefficients))
+        nlCoef = np.array([getattr(fn, 'Coefficients_getNlCoef%d' % i)(coefficients)
+                           for i in range(min(max(nlOrder, 0), 7) + 1)])
+        wlCoef = np.array([fn.Coefficients_getWlIntercept(coefficients),
+                           fn.Coefficients_getWlFirst(coefficients),
+                           fn.Coefficients_getWlSecond(coefficients),
+                           fn.Coefficients_getWlThird(coefficients)])
+        return {'nl_coef': nlCoef,
+                'nl_order': nlOrder,
+                'wl_coef': wlCoef,
+                'stray_light': float(fn.Coefficients_getStrayLight(coefficients))}
+    
     
     def __createDllDataTypes(self):
         """Private method: create the ctypes objects for the dll datatypes.
         @return none
         """
-        self.dllCoefficients = self.libOmniDriver.Coefficients_Create()
+        self.dllCoefficients = c_void_p(self.fnOmniDriver.Coefficients_Create())
         
-    def __loadLibraries(self):
+    def __loadLibraries(self, lib=None):
         """Private method: load the common library.
+        @param lib library object to use (default: None == load DEFAULT_COEFFICIENTS_LIBRARY)
         @return library object (pointer to OmniDriver64.dll)
         """
-        self.libOmniDriver = cdll.LoadLibrary('/home/tango-cs/OmniDriverSPAM/OOI_HOME/libOmniDriver.so')
+        if lib is None:
+            lib = cdll.LoadLibrary(DEFAULT_COEFFICIENTS_LIBRARY)
+        self.libOmniDriver = lib
+        self.fnOmniDriver = DllFunctions(self.libOmniDriver, COEFFICIENTS_PROTOTYPES)
         return self.libOmniDriver
     
     def __redirectDllOutput(self):
@@ -317,26 +411,178 @@ class OceansOpticsCoefficientsWrapper:
 
 
 
+class OmniDriverSession:
+    """OmniDriver wrapper object shared by all spectrometers of one process.
+    The serial numbers found on the USB bus are kept in a serial number -> index
+    map. The bus is enumerated again only when a serial number is not in it."""
+
+    __session = None
+    __sessionLock = threading.Lock()
+
+    def __init__(self, backend=None):
+        """Constructor.
+        @param backend library path, 'sim' or a simulator object (default: None == $OMNIDRIVER_BACKEND or DEFAULT_WRAPPER_LIBRARY)
+        """
+        self.serialNumbers = None       # serial number -> device index
+        self.lock = threading.Lock()
+        self.__loadLibraries(backend)   # load libraries
+        self.__redirectDllOutput()      # redirect stdout and stderr
+        self.__createDllDataTypes()     # create datatypes in python 
+
+    @classmethod
+    def GetSession(cls, backend=None):
+        """Public method: get the session of this process, created on first use.
+        @param backend backend of the session if it is created by this call (see constructor)
+        @return session (OmniDriverSession)
+        """
+        with cls.__sessionLock:
+            if cls.__session is None:
+                cls.__session = cls(backend)
+            return cls.__session
+
+    def OpenAllSpectrometers(self):
+        """Public method: open all spectrometers connected to the computer, unless some were found before.
+        @return serial number -> device index (dictionary)
+        """
+        with self.lock:
+            if not self.serialNumbers:
+                self.__enumerateSpectrometers()
+            return self.serialNumbers
+
+    def GetDeviceIndex(self, serialnumber):
+        """Public method: device index of the spectrometer with a given serial number.
+        The bus is enumerated again if it is not known (plugged in later or closed).
+        @param serialnumber Serialnumber of the spectrometer (string)
+        @return device index or -1 if not connected (int)
+        """
+        with self.lock:
+            if not self.serialNumbers or serialnumber not in self.serialNumbers:
+                self.__enumerateSpectrometers()
+            return self.serialNumbers.get(serialnumber, -1)
+
+    def ForgetSpectrometer(self, index):
+        """Public method: remove a closed spectrometer from the map, so that opening it again enumerates the bus.
+        @param index device index of the closed spectrometer
+        @return none
+        """
+        with self.lock:
+            for serialnumber, i in list((self.serialNumbers or {}).items()):
+                if i == index:
+                    del self.serialNumbers[serialnumber]
+
+    def __enumerateSpectrometers(self):
+        """Private method: open all spectrometers and map their serial numbers (with self.lock held).
+        @return none
+        """
+        try:
+            nrDevicesFound = self.fnOmniDriver.Wrapper_openAllSpectrometers(self.dllWrapper)
+        except:
+            nrDevicesFound = 0
+        self.serialNumbers = {}
+        for index in range(nrDevicesFound):
+            try:
+                self.fnOmniDriver.Wrapper_getSerialNumber(self.dllWrapper, index, self.dllJString)
+            except:
+                continue
+            serialnumber = self.JStringToStr(self.dllJString)
+            print('checking device index: %d - %s'%(index, serialnumber))
+            self.serialNumbers[serialnumber] = index
+
+    def JStringToStr(self, jstr):
+        """Public method: convert OO_JString to python string.
+        @param jstr JString object to convert
+        @return python string of jstr
+        """
+        text = self.fnCommon.JString_getASCII(jstr)
+        if not isinstance(text, str):
+            text = text.decode('ascii')
+        return text
+
+    def __createDllDataTypes(self):
+        """Private method: create the ctypes objects for the dll datatypes.
+        @return none
+        """
+        self.dllWrapper = c_void_p(self.fnOmniDriver.Wrapper_Create())
+        self.dllJString = c_void_p(self.fnCommon.JString_Create())
+
+    def __loadLibraries(self, backend=None):
+        """Private method: load the OO libraries, or create the simulator.
+        With a library path the coefficients library is $OMNIDRIVER_COEFFICIENTS_LIBRARY
+        or DEFAULT_COEFFICIENTS_LIBRARY; a simulator provides all three.
+        @param backend library path, 'sim' or a simulator object (default: None == $OMNIDRIVER_BACKEND or DEFAULT_WRAPPER_LIBRARY)
+        @return none
+        """
+        if backend is None:
+            backend = os.environ.get('OMNIDRIVER_BACKEND') or DEFAULT_WRAPPER_LIBRARY
+        if backend == 'sim':
+            from sim_omnidriver import SimulatedOmniDriver
+            backend = SimulatedOmniDriver.from_environment()
+        if isinstance(backend, str):
+            self.libOmniDriver = cdll.LoadLibrary(backend)
+            self.libCommon = cdll.LoadLibrary(backend)
+            self.libCoefficients = cdll.LoadLibrary(os.environ.get('OMNIDRIVER_COEFFICIENTS_LIBRARY')
+                                                    or DEFAULT_COEFFICIENTS_LIBRARY)
+        else:
+            self.libOmniDriver = self.libCommon = self.libCoefficients = backend
+        self.fnOmniDriver = DllFunctions(self.libOmniDriver, WRAPPER_PROTOTYPES)
+        self.fnCommon = DllFunctions(self.libCommon, COMMON_PROTOTYPES)
+    
+    def __redirectDllOutput(self):
+        """Private method: redirect the dll stdout and stderr to a log file (only windows).
+        @return none
+        """
+        if os.name == 'nt':
+            import msvcrt
+            k32 = windll.kernel32
+            fstdout = open("tmp_stdout_dll.log", 'w')
+            fstderr = open("tmp_stderr_dll.log", 'w')
+            k32.SetStdHandle(-11, msvcrt.get_osfhandle(fstdout.fileno()))
+            k32.SetStdHandle(-12, msvcrt.get_osfhandle(fstderr.fileno()))
+
+
+
+
 class OceansOpticsWrapper:
-    """Wrapper class to communicate with Oceans Optics Spectrometers.""" 
+    """Wrapper class to communicate with Oceans Optics Spectrometers.
+    All wrappers of a process share one OmniDriverSession.""" 
         
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, session=None):
         """Constructor.
         @param parent parent widget of this class (default: None)
+        @param session OmniDriver session to use (default: None == session shared by the process)
         """
+        if session is None:
+            session = OmniDriverSession.GetSession()
+        self.session = session
         self.nrOfPixels = -1            # number of pixels
-        self.__loadLibraries()          # load libraries
-        self.__redirectDllOutput()      # redirect stdout and stderr
+        self.libOmniDriver = session.libOmniDriver
+        self.libCommon = session.libCommon
+        # every driver call of this spectrometer is counted and timed
+        self.instrumentation = lib_instrumentation.Instrumentation()
+        self.fnOmniDriver = lib_instrumentation.InstrumentedFunctions(session.fnOmniDriver, self.instrumentation)
+        self.fnCommon = lib_instrumentation.InstrumentedFunctions(session.fnCommon, self.instrumentation)
         self.__createDllDataTypes()     # create datatypes in python 
-        self.coefficients = OceansOpticsCoefficientsWrapper()
+        self.coefficients = OceansOpticsCoefficientsWrapper(lib=session.libCoefficients)
     
     def GetCalibrationCoefficientsFromBuffer(self,  index= None):
         if index == None:
             index = self.deviceIndex
         if index == -1:
             return None
-        self.libOmniDriver.Wrapper_getCalibrationCoefficientsFromBuffer(self.dllWrapper, c_int(index), self.coefficients.dllCoefficients)
+        self.fnOmniDriver.Wrapper_getCalibrationCoefficientsFromBuffer(self.dllWrapper, index, self.coefficients.dllCoefficients)
         
+    def GetCalibrationCoefficients(self, index=None):
+        """Public method: read the calibration coefficients from the spectrometer buffer.
+        @param index optional: device index of the spectrometer (default: None == self.deviceIndex value)
+        @return coefficients (dictionary, see OceansOpticsCoefficientsWrapper.Snapshot) or None
+        """
+        if index == None:
+            index = self.deviceIndex
+        if index == -1:
+            return None
+        self.GetCalibrationCoefficientsFromBuffer(index)
+        return self.coefficients.Snapshot()
+    
     
     def GetDeviceIndex(self):
         """Public method: device index variable.
@@ -355,24 +601,15 @@ class OceansOpticsWrapper:
         @param serialnumber Serialnumber of the spectrometer to open (string)
         @return None
         """
-        self.deviceIndex = -1          
-        self.nrDevicesFound = -1
-        self.__openAllSpectrometers()
+        # the bus is only enumerated again if the serial number is not known yet
+        self.deviceIndex = self.session.GetDeviceIndex(serialnumber)
+        self.nrDevicesFound = len(self.session.serialNumbers)
         if self.nrDevicesFound == 0:
-            print "OceansOptics::No spectrometer found!"
+            print("OceansOptics::No spectrometer found!")
             return
-        # get the serial number of all spectrometers
-        for i in range(1, self.nrDevicesFound+1):
-            index = i -1
-            print 'checking device index: %d - %s'%(index, self.GetSerialNumber(index))
-            if self.GetSerialNumber(index)==serialnumber:
-                self.deviceIndex = index
-            else:
-                self.libOmniDriver.Wrapper_closeSpectrometer(self.dllWrapper, c_int(index))
-                    
-        print 'Device index: %d'%self.deviceIndex
+        print('Device index: %d'%self.deviceIndex)
         if self.deviceIndex == -1:
-            print "OceansOptics::No spectrometer with serial number < ",str(serialnumber)," > found!"
+            print("OceansOptics::No spectrometer with serial number < %s > found!"%serialnumber)
         return
 
     def CloseSpectrometer(self,  index=None):
@@ -385,8 +622,9 @@ class OceansOpticsWrapper:
         if index == -1:
             return None
         # the close command does not work correctly with python's ctype
-        self.libOmniDriver.Wrapper_closeSpectrometer(self.dllWrapper, c_int(index))
-        print 'closing spectrometer: %d'%self.deviceIndex
+        self.fnOmniDriver.Wrapper_closeSpectrometer(self.dllWrapper, index)
+        self.session.ForgetSpectrometer(index)
+        print('closing spectrometer: %d'%self.deviceIndex)
         self.deviceIndex = -1
 
     def GetSerialNumber(self, index=None):
@@ -399,7 +637,7 @@ class OceansOpticsWrapper:
         if index == -1:
             return None
         try:
-            self.libOmniDriver.Wrapper_getSerialNumber(self.dllWrapper, c_int(index), self.dllJString)
+            self.fnOmniDriver.Wrapper_getSerialNumber(self.dllWrapper, index, self.dllJString)
         except:
             pass
         return self.__JStringToStr()
@@ -413,7 +651,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return None
-        self.libOmniDriver.Wrapper_getName(self.dllWrapper, c_int(index), self.dllJString)
+        self.fnOmniDriver.Wrapper_getName(self.dllWrapper, index, self.dllJString)
         return self.__JStringToStr()
     
     def GetFirmwareVersion(self, index=None):
@@ -425,12 +663,13 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return None
-        self.libOmniDriver.Wrapper_getFirmwareVersion(self.dllWrapper, c_int(index), self.dllJString)
+        self.fnOmniDriver.Wrapper_getFirmwareVersion(self.dllWrapper, index, self.dllJString)
         return self.__JStringToStr()
     
-    def GetWavelengths(self, index=None):
+    def GetWavelengths(self, index=None, out=None):
         """Public method: get the calibrated wavelengths from the device.
         @param index optional: device index of the spectrometer (default: None == self.deviceIndex value)
+        @param out optional: preallocated float64 array to fill (default: None == new array)
         @return wavelengts array (numpy 1D array of float)
         """
         if index == None:
@@ -438,12 +677,13 @@ class OceansOpticsWrapper:
         if index == -1:
             return None
         self.GetNumberOfPixels(index)
-        self.libOmniDriver.Wrapper_getWavelengths(self.dllWrapper, c_int(index), self.dllDoubleArray)
-        return self.__DoubleArrayToArray()
+        self.fnOmniDriver.Wrapper_getWavelengths(self.dllWrapper, index, self.dllDoubleArray)
+        return self.__DoubleArrayToArray(out=out)
     
-    def GetSpectrum(self,  index=None):
+    def GetSpectrum(self,  index=None, out=None):
         """Public method: get the current spectrum intensities.
         @param index optional: device index of the spectrometer (default: None == self.deviceIndex value)
+        @param out optional: preallocated float64 array to fill (default: None == new array)
         @return intensities array (numpy 1D array of float)
         """
         if index == None:
@@ -451,11 +691,8 @@ class OceansOpticsWrapper:
         if index == -1:
             return None
         self.GetNumberOfPixels(index)
-        tstart = time.clock()
-        self.libOmniDriver.Wrapper_getSpectrum(self.dllWrapper, c_int(index), self.dllDoubleArray)
-        tend = time.clock()
-        #print "%.4gs" % (tend-tstart)
-        return self.__DoubleArrayToArray()
+        self.fnOmniDriver.Wrapper_getSpectrum(self.dllWrapper, index, self.dllDoubleArray)
+        return self.__DoubleArrayToArray(out=out)
     
     def GetNumberOfPixels(self, index = None):
         """Public method: get number of pixels from class attribute.
@@ -478,7 +715,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return None
-        self.nrOfPixels = int(self.libOmniDriver.Wrapper_getNumberOfPixels(self.dllWrapper, c_int(index)))
+        self.nrOfPixels = int(self.fnOmniDriver.Wrapper_getNumberOfPixels(self.dllWrapper, index))
         return self.nrOfPixels
     
     def GetCorrectForElectricalDark(self, index=None):
@@ -490,8 +727,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return None
-        self.libOmniDriver.Wrapper_getCorrectForElectricalDark.restype = c_short
-        return self.libOmniDriver.Wrapper_getCorrectForElectricalDark(self.dllWrapper, c_int(index))
+        return self.fnOmniDriver.Wrapper_getCorrectForElectricalDark(self.dllWrapper, index)
     
     def SetCorrectForElectricalDark(self, enable, index=None):
         """Public method: set the electronic dark compenstion on/off.
@@ -503,7 +739,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return None
-        self.libOmniDriver.Wrapper_setCorrectForElectricalDark(self.dllWrapper, c_int(index), c_int(enable))
+        self.fnOmniDriver.Wrapper_setCorrectForElectricalDark(self.dllWrapper, index, enable)
     
     def GetCorrectForStrayLight(self, index=None):
         """Public method: get status of stray light correctin.
@@ -514,8 +750,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return None
-        self.libOmniDriver.Wrapper_getCorrectForStrayLight.restype = c_short
-        return self.libOmniDriver.Wrapper_getCorrectForStrayLight(self.dllWrapper, c_int(index))
+        return self.fnOmniDriver.Wrapper_getCorrectForStrayLight(self.dllWrapper, index)
  
     def GetCorrectForDetectorNonlinearity(self, index=None):
         """Public method: get status of detector nonlinearity correction.
@@ -526,8 +761,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return None
-        self.libOmniDriver.Wrapper_getCorrectForDetectorNonlinearity.restype = c_short
-        return self.libOmniDriver.Wrapper_getCorrectForDetectorNonlinearity(self.dllWrapper, c_int(index))
+        return self.fnOmniDriver.Wrapper_getCorrectForDetectorNonlinearity(self.dllWrapper, index)
     
     def SetCorrectForDetectorNonlinearity(self, enable, index=None):
         """Public method: set the detector nonlineartity correction on/off.
@@ -538,7 +772,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return None
-        self.libOmniDriver.Wrapper_setCorrectForDetectorNonlinearity(self.dllWrapper, c_int(index), c_int(enable))
+        self.fnOmniDriver.Wrapper_setCorrectForDetectorNonlinearity(self.dllWrapper, index, enable)
    
     def GetIntegrationTime(self, index=None):
         """Public method: get the current integration time from the device.
@@ -549,8 +783,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return None
-        self.libOmniDriver.Wrapper_getIntegrationTime.restype = c_int
-        return self.libOmniDriver.Wrapper_getIntegrationTime(self.dllWrapper, c_int(index))
+        return self.fnOmniDriver.Wrapper_getIntegrationTime(self.dllWrapper, index)
     
     def SetIntegrationTime(self, usec, index=None):
         """Public method: set the integration time usec.
@@ -562,7 +795,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return None
-        self.libOmniDriver.Wrapper_setIntegrationTime(self.dllWrapper, c_int(index), c_int(usec))
+        self.fnOmniDriver.Wrapper_setIntegrationTime(self.dllWrapper, index, usec)
    
     def GetScansToAverage(self, index=None):
         """Public method: get number of scans to average.
@@ -573,8 +806,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return -1
-        self.libOmniDriver.Wrapper_getScansToAverage.restype = c_int
-        return self.libOmniDriver.Wrapper_getScansToAverage(self.dllWrapper, c_int(index))
+        return self.fnOmniDriver.Wrapper_getScansToAverage(self.dllWrapper, index)
       
     def SetScansToAverage(self, number,  index=None):
         """Public method: set number of scans to average.
@@ -586,7 +818,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return None
-        self.libOmniDriver.Wrapper_setScansToAverage(self.dllWrapper, c_int(index), c_int(number))
+        self.fnOmniDriver.Wrapper_setScansToAverage(self.dllWrapper, index, number)
         return None
     
     def GetMinimumIntegrationTime(self, index=None):
@@ -598,8 +830,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return -1
-        self.libOmniDriver.Wrapper_getMinimumIntegrationTime.restype = c_int
-        return self.libOmniDriver.Wrapper_getMinimumIntegrationTime(self.dllWrapper, c_int(index))
+        return self.fnOmniDriver.Wrapper_getMinimumIntegrationTime(self.dllWrapper, index)
 
     def GetMaximumIntegrationTime(self, index=None):
         """Public method: get maximum integration time in usec.
@@ -610,10 +841,9 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return -1
-        self.libOmniDriver.Wrapper_getMaximumIntegrationTime.restype = c_int
-        return self.libOmniDriver.Wrapper_getMaximumIntegrationTime(self.dllWrapper, c_int(index))
+        return self.fnOmniDriver.Wrapper_getMaximumIntegrationTime(self.dllWrapper, index)
 
-    def GetMaximumIntensity(self, index):
+    def GetMaximumIntensity(self, index=None):
         """Public method: get maximum intensity of device.
         @param index optional: device index of the spectrometer (default: None == self.deviceIndex value)
         @return maximum intensity (int)
@@ -622,8 +852,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return -1
-        self.libOmniDriver.Wrapper_getMaximumIntensity.restype = c_int
-        return self.libOmniDriver.Wrapper_getMaximumIntensity(self.dllWrapper, c_int(index))
+        return self.fnOmniDriver.Wrapper_getMaximumIntensity(self.dllWrapper, index)
 
     def IsSaturated(self, index=None):
         """Public method: check if detector is saturated.
@@ -634,8 +863,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return -1
-        self.libOmniDriver.Wrapper_isSaturated.restype = c_short
-        return self.libOmniDriver.Wrapper_isSaturated(self.dllWrapper, c_int(index))
+        return self.fnOmniDriver.Wrapper_isSaturated(self.dllWrapper, index)
 
     def IsTimeout(self, index=None):
         """Public method: check for timeout.
@@ -646,8 +874,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return -1
-        self.libOmniDriver.Wrapper_isTimeout.restype = c_short
-        return self.libOmniDriver.Wrapper_isTimeout(self.dllWrapper, c_int(index))
+        return self.fnOmniDriver.Wrapper_isTimeout(self.dllWrapper, index)
 
     def SetTimeout(self, msec, index=None):
         """Public method: set timeout in msec of the device.
@@ -659,8 +886,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return -1
-        self.libOmniDriver.Wrapper_setTimeout.restype = c_int
-        return self.libOmniDriver.Wrapper_setTimeout(self.dllWrapper, c_int(index), c_int(msec))
+        return self.fnOmniDriver.Wrapper_setTimeout(self.dllWrapper, index, msec)
 
     def IsSpectrumValid(self, index=None):
         """Public method: check if spectrum is valid.
@@ -671,8 +897,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return -1
-        self.libOmniDriver.Wrapper_isSpectrumValid.restype = c_short
-        return self.libOmniDriver.Wrapper_isSpectrumValid(self.dllWrapper, c_int(index))
+        return self.fnOmniDriver.Wrapper_isSpectrumValid(self.dllWrapper, index)
 
     def StopAveraging(self, index=None):
         """Public method: stop the averaging process.
@@ -683,7 +908,7 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return None
-        self.libOmniDriver.Wrapper_stopAveraging(self.dllWrapper, c_int(index))
+        self.fnOmniDriver.Wrapper_stopAveraging(self.dllWrapper, index)
 
     def FlushSpectrum(self, index=None):
         """Public method: flush the current spectrum.
@@ -694,21 +919,26 @@ class OceansOpticsWrapper:
             index = self.deviceIndex
         if index == -1:
             return -1
-        self.libOmniDriver.Wrapper_flushSpectrum.restype = c_short
-        return self.libOmniDriver.Wrapper_flushSpectrum(self.dllWrapper, c_int(index))
+        return self.fnOmniDriver.Wrapper_flushSpectrum(self.dllWrapper, index)
 
 
-    def __DoubleArrayToArray(self, arrIn=None):
+    def __DoubleArrayToArray(self, arrIn=None, out=None):
         """Private method: convert OO_DoubleArray to numpy array object.
+        The driver buffer is viewed in place and copied exactly once, either into
+        a fresh array or into the preallocated array out. The first three pixels
+        are dropped by slicing.
         @param arrIn Array object to convert (default: None == uses the class object self.dllDoubleArray
+        @param out optional: preallocated float64 array of nrOfPixels-3 elements to copy into (default: None)
         @return numpy array object of arrIN
         """
-        if arrIn == None:
+        if arrIn is None:
             arrIn = self.dllDoubleArray
-        self.libCommon.DoubleArray_getDoubleValues.restype = POINTER(c_double * int(self.nrOfPixels))
-        pArr = self.libCommon.DoubleArray_getDoubleValues(arrIn)
-        value = np.array(list(pArr.contents))
-        return np.delete(value, [0, 1, 2], axis=0)
+        pArr = self.fnCommon.DoubleArray_getDoubleValues(arrIn)
+        view = np.ctypeslib.as_array(pArr, shape=(int(self.nrOfPixels),))[3:]
+        if out is None:
+            return view.copy()
+        np.copyto(out, view)
+        return out
 
     def __JStringToStr(self, jstr=None):
         """Private method: convert OO_JString to python string.
@@ -717,44 +947,15 @@ class OceansOpticsWrapper:
         """
         if jstr == None:
             jstr= self.dllJString
-        text = c_char_p(self.libCommon.JString_getASCII(jstr))
-        return str(text.value)
-
-    def __openAllSpectrometers(self):
-        """Private method: open all Spectrometers connected to the computer.
-        @return none
-        """
-        try:
-            self.libOmniDriver.Wrapper_openAllSpectrometers.restype = c_int
-            self.nrDevicesFound = self.libOmniDriver.Wrapper_openAllSpectrometers(self.dllWrapper)
-        except:
-            self.nrDevicesFound = 0
+        return self.session.JStringToStr(jstr)
     
     def __createDllDataTypes(self):
         """Private method: create the ctypes objects for the dll datatypes.
+        The wrapper object belongs to the session, the buffers to this spectrometer.
         @return none
         """
-        self.dllWrapper = c_void_p(self.libOmniDriver.Wrapper_Create())
-        self.dllJString = self.libCommon.JString_Create()
-        self.dllDoubleArray = c_void_p(self.libCommon.DoubleArray_Create())
-        
-    def __loadLibraries(self):
-        """Private method: load the OO libraries.
-        @return none
-        """
-        self.libOmniDriver = cdll.LoadLibrary('./libw.so')
-        self.libCommon = cdll.LoadLibrary('./libw.so')
-    
-    def __redirectDllOutput(self):
-        """Private method: redirect the dll stdout and stderr to a log file (only windows).
-        @return none
-        """
-        if os.name == 'nt':
-            import msvcrt
-            k32 = windll.kernel32
-            fstdout = open("tmp_stdout_dll.log", 'w')
-            fstderr = open("tmp_stderr_dll.log", 'w')
-            k32.SetStdHandle(-11, msvcrt.get_osfhandle(fstdout.fileno()))
-            k32.SetStdHandle(-12, msvcrt.get_osfhandle(fstderr.fileno()))
+        self.dllWrapper = self.session.dllWrapper
+        self.dllJString = c_void_p(self.fnCommon.JString_Create())
+        self.dllDoubleArray = c_void_p(self.fnCommon.DoubleArray_Create())
 
 
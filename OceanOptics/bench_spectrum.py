@@ -0,0 +1,244 @@
+#Latency benchmark of the spectrum read path, from the driver call to a
+#client holding the decoded Spectrum. Runs against the simulated OmniDriver
+#(sim_omnidriver.py) without integration time delays, or replays a recording
+#made with StartRecording, so it measures the software path only.
+#
+#Stages, timed per frame:
+#  driver      Wrapper_getSpectrum into the driver's DoubleArray
+#  conversion  DoubleArray to numpy (the copy in OceansOpticsWrapper.GetSpectrum)
+#  corrections dark subtraction, host nonlinearity and stray light correction
+#              and, if enabled, host averaging
+#  output      region of interest, binning and the float32 cast
+#  tango       read of Spectrum through a DeviceProxy without client side
+#              extraction (server read, serialization and transport), --tango
+#  decode      extra cost of extracting the value to numpy on the client, --tango
+#
+#Examples:
+#  python bench_spectrum.py --save before.json
+#  python bench_spectrum.py --save after.json --compare before.json
+#  python bench_spectrum.py --replay /data/run1.h5 --tango
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy
+
+from PyOceansOpticsWrapper import OceansOpticsWrapper, OmniDriverSession
+import lib_acquisition
+import lib_darks
+import lib_processing
+import sim_omnidriver
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+
+STAGES = ["driver", "conversion", "corrections", "output", "tango", "decode"]
+
+
+
+def summarize(samples):
+    """Statistics in microseconds of a list of durations in seconds."""
+    us = numpy.asarray(samples)*1e6
+    return {"n": len(us),
+            "median_us": float(numpy.median(us)),
+            "p95_us": float(numpy.percentile(us, 95)),
+            "mean_us": float(numpy.mean(us)),
+            "min_us": float(numpy.min(us))}
+
+
+def bench_local(session, serial, scans, host_averaging, binning, repeat, warmup):
+    """Time the in-process stages for one spectrometer and setting."""
+    wrapper = OceansOpticsWrapper(session=session)
+    wrapper.OpenSpectrometer(serial)
+    wrapper.SetIntegrationTime(wrapper.GetMinimumIntegrationTime())
+    wrapper.SetScansToAverage(scans)
+    index = wrapper.GetDeviceIndex()
+    nr_of_pixels = wrapper.GetNumberOfPixels() - 3
+    frame = numpy.zeros(nr_of_pixels)
+    darks = lib_darks.DarkLibrary(1)
+    key = darks.make_key(wrapper.GetIntegrationTime(), scans, 0, 0)
+    darks.put(key, numpy.full(nr_of_pixels, 100.0))
+    calibration = wrapper.GetCalibrationCoefficients()
+    scratch = numpy.zeros(nr_of_pixels)
+    averager = lib_acquisition.StreamingAverager(nr_of_pixels, repeat + warmup)
+    #the copy done by GetSpectrum, without the driver call in front of it
+    convert = wrapper._OceansOpticsWrapper__DoubleArrayToArray
+    samples = dict((stage, []) for stage in STAGES[:4])
+    for i in range(warmup + repeat):
+        t0 = clock()
+        wrapper.fnOmniDriver.Wrapper_getSpectrum(wrapper.dllWrapper, index, wrapper.dllDoubleArray)
+        t1 = clock()
+        convert(out=frame)
+        t2 = clock()
+        darks.subtract(frame, key)
+        lib_processing.correct_nonlinearity(frame, calibration["nl_coef"], scratch=scratch)
+        lib_processing.correct_stray_light(frame, calibration["stray_light"])
+        if host_averaging:
+            averager.update(frame)
+        t3 = clock()
+        lib_processing.cast(lib_processing.roi_bin(frame, 0, None, binning), numpy.float32)
+        t4 = clock()
+        if i >= warmup:
+            samples["driver"].append(t1 - t0)
+            samples["conversion"].append(t2 - t1)
+            samples["corrections"].append(t3 - t2)
+            samples["output"].append(t4 - t3)
+    return nr_of_pixels, samples
+
+
+def bench_tango(serial, scans, host_averaging, binning, repeat, warmup):
+    """Time reads of Spectrum from a device in a forked test server. Returns
+    None if PyTango or its test context is not available."""
+    try:
+        import PyTango
+        from PyTango.test_context import DeviceTestContext
+        from dev_OceanOptics import OceanOpticsSpectrometer
+    except ImportError as e:
+        print("Skipping the Tango stages: %s" %e)
+        return None
+    samples = {"tango": [], "decode": []}
+    with DeviceTestContext(OceanOpticsSpectrometer, properties={"serial_port": serial},
+                           process=True) as proxy:
+        proxy.ScansToAverage = scans
+        proxy.Binning = binning
+        proxy.HostScansToAverage = repeat + warmup + 1
+        proxy.HostAveraging = bool(host_averaging)
+        proxy.StartStream()
+        time.sleep(0.2)
+        for i in range(warmup + repeat):
+            #the difference of a raw and a numpy read is the client decode
+            t0 = clock()
+            proxy.read_attribute("Spectrum", extract_as=PyTango.ExtractAs.Nothing)
+            t1 = clock()
+            proxy.read_attribute("Spectrum", extract_as=PyTango.ExtractAs.Numpy)
+            t2 = clock()
+            if i >= warmup:
+                samples["tango"].append(t1 - t0)
+                samples["decode"].append(max(0.0, (t2 - t1) - (t1 - t0)))
+        proxy.StopStream()
+    return samples
+
+
+def environment():
+    """Versions and commit the results were measured with."""
+    try:
+        commit = subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        commit = commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ""
+    return {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "commit": commit,
+            "host": platform.node(),
+            "machine": platform.machine(),
+            "python": platform.python_version(),
+            "numpy": numpy.__version__}
+
+
+def config_key(result):
+    return (result["pixels"], result["scans"], result["host_averaging"], result["binning"])
+
+
+def compare(results, baseline, tolerance):
+    """Print the median of every stage against the baseline. Returns the
+    number of stages slower than baseline by more than tolerance."""
+    reference = dict((config_key(result), result) for result in baseline["results"])
+    regressions = 0
+    print("\nCompared with %s (%s):" %(baseline["environment"].get("commit") or "baseline",
+                                       baseline["environment"].get("date", "")))
+    for result in results:
+        old = reference.get(config_key(result))
+        if old is None:
+            continue
+        for stage, stats in sorted(result["stages"].items()):
+            if stage not in old["stages"]:
+                continue
+            ratio = stats["median_us"]/max(old["stages"][stage]["median_us"], 1e-3)
+            flag = ""
+            if ratio > 1 + tolerance:
+                flag = "  REGRESSION"
+                regressions += 1
+            print("  pixels=%-5d scans=%-3d avg=%d bin=%d %-12s %10.1f -> %10.1f us  x%.2f%s"
+                  %(config_key(result) + (stage, old["stages"][stage]["median_us"],
+                                          stats["median_us"], ratio, flag)))
+    return regressions
+
+
+def parse_list(text):
+    return [int(value) for value in text.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latency benchmark of the spectrum read path.")
+    parser.add_argument("--pixels", type=parse_list, default=[1044, 2048, 3648],
+                        help="comma separated pixel counts of the simulated spectrometers")
+    parser.add_argument("--scans", type=parse_list, default=[1, 10],
+                        help="comma separated ScansToAverage settings")
+    parser.add_argument("--host-averaging", type=parse_list, default=[0, 1],
+                        help="host averaging settings to run (0, 1 or 0,1)")
+    parser.add_argument("--binning", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=200, help="timed frames per setting")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed frames per setting")
+    parser.add_argument("--replay", help="replay this recording instead of simulating spectra")
+    parser.add_argument("--tango", action="store_true",
+                        help="also time reads through a Tango test server")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative slowdown reported as a regression (default 0.2)")
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        spectrometers = [sim_omnidriver.RecordedSpectrometer.from_file(args.replay, "BENCH0")]
+    else:
+        spectrometers = [sim_omnidriver.SimulatedSpectrometer("BENCH%d" %pixels, nr_of_pixels=pixels + 3,
+                                                              min_integration_time=10, seed=0)
+                         for pixels in args.pixels]
+    simulator = sim_omnidriver.SimulatedOmniDriver(spectrometers, realtime=False)
+    #the Tango device opens the process session, which the forked server inherits
+    session = OmniDriverSession.GetSession(simulator)
+    if session.libOmniDriver is not simulator:
+        parser.error("the OmniDriver session was already created with another backend")
+
+    results = []
+    for spectrometer in spectrometers:
+        for scans in args.scans:
+            for host_averaging in args.host_averaging:
+                pixels, samples = bench_local(session, spectrometer.serial_number, scans,
+                                              host_averaging, args.binning, args.repeat, args.warmup)
+                if args.tango:
+                    samples.update(bench_tango(spectrometer.serial_number, scans, host_averaging,
+                                               args.binning, args.repeat, args.warmup) or {})
+                stages = dict((stage, summarize(values)) for stage, values in samples.items())
+                total = sum(stats["median_us"] for stats in stages.values())
+                result = {"pixels": pixels, "scans": scans, "host_averaging": host_averaging,
+                          "binning": args.binning, "stages": stages,
+                          "total_median_us": total, "throughput_hz": 1e6/total}
+                results.append(result)
+                print("pixels=%-5d scans=%-3d avg=%d  %s  total %.1f us (%.0f frames/s)"
+                      %(pixels, scans, host_averaging,
+                        "  ".join("%s %.1f" %(stage, stages[stage]["median_us"])
+                                  for stage in STAGES if stage in stages),
+                        total, result["throughput_hz"]))
+
+    report = {"environment": environment(), "results": results}
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    regressions = 0
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
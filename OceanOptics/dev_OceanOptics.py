@@ -0,0 +1,1048 @@
+import os
+import sys
+
+import numpy
+import PyTango
+from PyTango import DispLevel, AttrWriteType, DevState, AttrQuality
+from PyTango.server import DeviceMeta, Device, server_run
+from PyTango.server import command, attribute, device_property
+
+from PyOceansOpticsWrapper import OceansOpticsWrapper
+import lib_acquisition
+import lib_darks
+import lib_processing
+import lib_recorder
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+import lib_instrumentation
+
+class OceanOpticsSpectrometer(Device):
+    """Ocean Optics Spectrometer class"""
+
+    __metaclass__ = DeviceMeta
+    #properties
+    serial_port = device_property(dtype = str, default_value= "")
+    buffer_depth = device_property(dtype = int, default_value = 16,
+                                   doc = "Number of frames in the acquisition ring buffer.")
+    dark_library_size = device_property(dtype = int, default_value = 32,
+                                        doc = "Maximum number of dark frames kept in the dark library.")
+    dark_library_path = device_property(dtype = str, default_value = "",
+                                        doc = "Directory where the dark library is persisted (empty = not persisted).")
+
+    record_compression = device_property(dtype = str, default_value = "gzip",
+                                         doc = "HDF5 compression filter of recordings (gzip, lzf or empty for none).")
+    record_queue_size = device_property(dtype = int, default_value = 256,
+                                        doc = "Number of frames the recorder can buffer before frames are dropped.")
+
+    #upper limit of AcquireBurst, fixed by the dimensions of the Burst attribute
+    MAX_BURST_FRAMES = 1000
+    #upper limit of the number of Bands, fixed by the dimensions of BandIntegrals
+    MAX_BANDS = 16
+
+    #Attributes
+    Index = attribute(label = "index", unit = "", dtype = int,
+                      display_level=DispLevel.EXPERT,
+                      access = AttrWriteType.READ,
+                      doc = "Spectrometer index")
+
+    IntegrationTime = attribute(label = "Integration time",
+                                display_level=DispLevel.OPERATOR,
+                                unit = "micro seconds", dtype = int,
+                                min_value = 0, access = AttrWriteType.READ_WRITE,
+                                doc = "The Integration time used for acquiring the spectrum")
+
+    DarkCorrection = attribute(label = "Dark correction", unit = "",
+                               display_level=DispLevel.OPERATOR,
+                               dtype = bool, access = AttrWriteType.READ_WRITE,
+                               doc = "electrical dark noise correction")
+
+    NonLinearityCorrection = attribute(label = "Nonlinearity correction", unit = "",
+                               display_level=DispLevel.OPERATOR,
+                               dtype = bool, access = AttrWriteType.READ_WRITE,
+                               doc = "Nonlinearity correction")
+
+    StrayLightCorrection = attribute(label = "Stray light correction", unit = "",
+                                     display_level=DispLevel.OPERATOR,
+                                     dtype = bool, access = AttrWriteType.READ,
+                                     doc = "Stray light correction")
+
+    IsSpectrumValid = attribute(label = "Is spectrum Valid?", unit = "",
+                                display_level=DispLevel.EXPERT,
+                                dtype = int, access = AttrWriteType.READ,
+                                min_value = 0, max_value = 1,
+                                doc = "Reads if spectrum is valid")
+
+    IsSaturated = attribute(label = "is spectrum saturated?", unit = "",
+                                display_level=DispLevel.EXPERT,
+                                dtype = int, access = AttrWriteType.READ,
+                                min_value = 0, max_value = 1,
+                                doc = "Reads if spectrum is saturated")
+
+
+
+
+    ScansToAverage = attribute(label = "Scans to average", unit = "", dtype = int,
+                               min_value = 1, display_level=DispLevel.OPERATOR,
+                               access = AttrWriteType.READ_WRITE,
+                               doc = "Number of scans to average over")
+
+
+    Spectrum = attribute(label = "Spectrum", unit = "",
+                         display_level=DispLevel.OPERATOR,
+                       	 dtype=[numpy.float32,],
+                         max_dim_x=3645, max_dim_y=0,
+                         access = AttrWriteType.READ,
+                         doc = "Spectrum: X-axis:pixel number, Y-axis: pixel value. Use Wavelengths() function to get the wavelengths corresponding to the pixel values.")
+
+    RawSpectrum = attribute(label = "Raw spectrum", unit = "",
+                            display_level=DispLevel.OPERATOR,
+                            dtype=[numpy.uint32,],
+                            max_dim_x=3645, max_dim_y=0,
+                            access = AttrWriteType.READ,
+                            doc = "Uncorrected, unaveraged spectrum as counts (same region of interest and binning as Spectrum). Binned pixels are summed, as 32 bit integers so the sums of 16 bit detectors do not clip.")
+
+    Wavelengths = attribute(label = "Wavelengths", unit = "nm",
+                            display_level=DispLevel.OPERATOR,
+                       	    dtype=[float,],
+                            max_dim_x=3645, max_dim_y=0,
+                            access = AttrWriteType.READ,
+                            doc = "Wavelengths of each pixel in the most recently acquired spectrum spectrum.")
+
+    CalibrationCoefficients = attribute(label = "Calibration coefficients",
+                                        display_level=DispLevel.EXPERT,
+                       	                dtype=[float,],
+                                        max_dim_x=4, max_dim_y=0,
+                                        access = AttrWriteType.READ,
+                                        doc = "Read the callibration coefficients, used for converting pixel values into wavelengths, from the spectrometers buffer.")
+
+    Streaming = attribute(label = "Streaming", unit = "",
+                          display_level=DispLevel.OPERATOR,
+                          dtype = bool, access = AttrWriteType.READ,
+                          doc = "True while the background acquisition stream is running.")
+
+    BufferDepth = attribute(label = "Buffer depth", unit = "frames",
+                            display_level=DispLevel.EXPERT,
+                            dtype = int, access = AttrWriteType.READ,
+                            doc = "Number of frames the acquisition ring buffer holds.")
+
+    BufferFill = attribute(label = "Buffer fill", unit = "frames",
+                           display_level=DispLevel.EXPERT,
+                           dtype = int, access = AttrWriteType.READ,
+                           doc = "Number of valid frames currently in the ring buffer.")
+
+    FrameNumber = attribute(label = "Frame number", unit = "",
+                            display_level=DispLevel.EXPERT,
+                            dtype = int, access = AttrWriteType.READ,
+                            doc = "Sequence number of the most recent frame of the acquisition stream.")
+
+    FrameTimestamp = attribute(label = "Frame timestamp", unit = "s",
+                               display_level=DispLevel.EXPERT,
+                               dtype = float, access = AttrWriteType.READ,
+                               doc = "Acquisition time (seconds since the epoch) of the most recent frame of the acquisition stream.")
+
+    EventMinInterval = attribute(label = "Event minimum interval", unit = "ms",
+                                 display_level=DispLevel.EXPERT,
+                                 dtype = float, min_value = 0,
+                                 access = AttrWriteType.READ_WRITE,
+                                 memorized = True, hw_memorized = True,
+                                 doc = "Minimum time between two Spectrum events. Frames arriving faster are not published (0 = publish every frame).")
+
+    DroppedEvents = attribute(label = "Dropped events", unit = "frames",
+                              display_level=DispLevel.EXPERT,
+                              dtype = int, access = AttrWriteType.READ,
+                              doc = "Number of frames of the current stream that were not published because of throttling or a slow event channel.")
+
+    HostAveraging = attribute(label = "Host averaging", unit = "",
+                              display_level=DispLevel.OPERATOR,
+                              dtype = bool, access = AttrWriteType.READ_WRITE,
+                              doc = "Average the acquisition stream on the host. Spectrum then returns the running mean. Set ScansToAverage to 1 to average single scans.")
+
+    HostScansToAverage = attribute(label = "Host scans to average", unit = "",
+                                   display_level=DispLevel.OPERATOR,
+                                   dtype = int, min_value = 1,
+                                   access = AttrWriteType.READ_WRITE,
+                                   doc = "Maximum number of streamed frames averaged on the host.")
+
+    TargetSNR = attribute(label = "Target SNR", unit = "",
+                          display_level=DispLevel.OPERATOR,
+                          dtype = float, min_value = 0,
+                          access = AttrWriteType.READ_WRITE,
+                          doc = "Stop host averaging as soon as the signal to noise ratio of the mean at the brightest pixel reaches this value (0 = always average HostScansToAverage frames).")
+
+    AveragedScans = attribute(label = "Averaged scans", unit = "",
+                              display_level=DispLevel.OPERATOR,
+                              dtype = int, access = AttrWriteType.READ,
+                              doc = "Number of frames in the current host average.")
+
+    AveragingDone = attribute(label = "Averaging done", unit = "",
+                              display_level=DispLevel.OPERATOR,
+                              dtype = bool, access = AttrWriteType.READ,
+                              doc = "True once the host average reached HostScansToAverage frames or TargetSNR.")
+
+    SNR = attribute(label = "Signal to noise ratio", unit = "",
+                    display_level=DispLevel.OPERATOR,
+                    dtype = float, access = AttrWriteType.READ,
+                    doc = "Signal to noise ratio of the host average at its brightest pixel.")
+
+    SpectrumStdDev = attribute(label = "Spectrum standard deviation", unit = "",
+                               display_level=DispLevel.OPERATOR,
+                               dtype=[numpy.float32,],
+                               max_dim_x=3645, max_dim_y=0,
+                               access = AttrWriteType.READ,
+                               doc = "Per pixel standard deviation of the frames in the host average.")
+
+    DarkSubtraction = attribute(label = "Dark subtraction", unit = "",
+                                display_level=DispLevel.OPERATOR,
+                                dtype = bool, access = AttrWriteType.READ_WRITE,
+                                doc = "Subtract the dark frame from the dark library that matches the current integration time, scans to average and correction flags.")
+
+    DarkAvailable = attribute(label = "Dark available", unit = "",
+                              display_level=DispLevel.OPERATOR,
+                              dtype = bool, access = AttrWriteType.READ,
+                              doc = "True if the dark library holds a dark frame for the current settings.")
+
+    DarkLibrarySize = attribute(label = "Dark library size", unit = "frames",
+                                display_level=DispLevel.EXPERT,
+                                dtype = int, access = AttrWriteType.READ,
+                                doc = "Number of dark frames in the dark library.")
+
+    HostNonLinearityCorrection = attribute(label = "Host nonlinearity correction", unit = "",
+                                           display_level=DispLevel.OPERATOR,
+                                           dtype = bool, access = AttrWriteType.READ_WRITE,
+                                           doc = "Correct the detector nonlinearity on the host with the coefficients read at init. Turns the driver correction off.")
+
+    HostStrayLightCorrection = attribute(label = "Host stray light correction", unit = "",
+                                         display_level=DispLevel.OPERATOR,
+                                         dtype = bool, access = AttrWriteType.READ_WRITE,
+                                         doc = "Subtract the stray light on the host with the coefficient read at init.")
+
+    Burst = attribute(label = "Burst", unit = "",
+                      display_level=DispLevel.OPERATOR,
+                      dtype=((numpy.float32,),),
+                      max_dim_x=3645, max_dim_y=MAX_BURST_FRAMES,
+                      access = AttrWriteType.READ,
+                      doc = "Spectra of the last AcquireBurst, one frame per row.")
+
+    BurstTimestamps = attribute(label = "Burst timestamps", unit = "s",
+                                display_level=DispLevel.OPERATOR,
+                                dtype=[float,],
+                                max_dim_x=MAX_BURST_FRAMES, max_dim_y=0,
+                                access = AttrWriteType.READ,
+                                doc = "Acquisition time (seconds since the epoch) of each row of Burst.")
+
+    RoiPixels = attribute(label = "ROI pixels", unit = "",
+                          display_level=DispLevel.OPERATOR,
+                          dtype=[int,],
+                          max_dim_x=2, max_dim_y=0,
+                          access = AttrWriteType.READ_WRITE,
+                          doc = "[first pixel, last pixel + 1] of the region of interest applied to Spectrum, Wavelengths, SpectrumStdDev, Burst and the Spectrum events.")
+
+    RoiWavelengths = attribute(label = "ROI wavelengths", unit = "nm",
+                               display_level=DispLevel.OPERATOR,
+                               dtype=[float,],
+                               max_dim_x=2, max_dim_y=0,
+                               access = AttrWriteType.READ_WRITE,
+                               doc = "[lowest, highest] wavelength of the region of interest. Writing selects the pixels in this range.")
+
+    Binning = attribute(label = "Binning", unit = "pixels",
+                        display_level=DispLevel.OPERATOR,
+                        dtype = int, min_value = 1,
+                        access = AttrWriteType.READ_WRITE,
+                        doc = "Number of neighbouring pixels of the region of interest summed into one value (wavelengths are averaged).")
+
+    Bands = attribute(label = "Bands", unit = "nm",
+                      display_level=DispLevel.OPERATOR,
+                      dtype=[float,],
+                      max_dim_x=2*MAX_BANDS, max_dim_y=0,
+                      access = AttrWriteType.READ_WRITE,
+                      doc = "[first, last, first, last, ...] wavelengths of the bands integrated into BandIntegrals.")
+
+    BandIntegrals = attribute(label = "Band integrals", unit = "counts nm",
+                              display_level=DispLevel.OPERATOR,
+                              dtype=[float,],
+                              max_dim_x=MAX_BANDS, max_dim_y=0,
+                              access = AttrWriteType.READ,
+                              doc = "Integral over wavelength of the full resolution spectrum in each band, computed for every frame.")
+
+    PeakWindow = attribute(label = "Peak window", unit = "nm",
+                           display_level=DispLevel.OPERATOR,
+                           dtype=[float,],
+                           max_dim_x=2, max_dim_y=0,
+                           access = AttrWriteType.READ_WRITE,
+                           doc = "[first, last] wavelength searched for the peak (empty = whole spectrum).")
+
+    PeakCentroid = attribute(label = "Peak centroid", unit = "nm",
+                             display_level=DispLevel.OPERATOR,
+                             dtype = float, access = AttrWriteType.READ,
+                             doc = "Intensity weighted wavelength of the pixels above half maximum of the highest peak in PeakWindow.")
+
+    PeakHeight = attribute(label = "Peak height", unit = "counts",
+                           display_level=DispLevel.OPERATOR,
+                           dtype = float, access = AttrWriteType.READ,
+                           doc = "Height of the highest peak in PeakWindow above the minimum of the window.")
+
+    PeakWidth = attribute(label = "Peak width", unit = "nm",
+                          display_level=DispLevel.OPERATOR,
+                          dtype = float, access = AttrWriteType.READ,
+                          doc = "Full width at half maximum of the highest peak in PeakWindow (nan if not resolved).")
+
+    AutoExposeTarget = attribute(label = "Auto exposure target", unit = "",
+                                 display_level=DispLevel.OPERATOR,
+                                 dtype = float, min_value = 0.05, max_value = 0.98,
+                                 access = AttrWriteType.READ_WRITE,
+                                 doc = "Peak counts AutoExpose aims for, as a fraction of the maximum intensity of the detector.")
+
+    AutoExposeProbes = attribute(label = "Auto exposure probes", unit = "",
+                                 display_level=DispLevel.EXPERT,
+                                 dtype = int, access = AttrWriteType.READ,
+                                 doc = "Number of acquisitions used by the last AutoExpose.")
+
+    Recording = attribute(label = "Recording", unit = "",
+                          display_level=DispLevel.OPERATOR,
+                          dtype = bool, access = AttrWriteType.READ,
+                          doc = "True while streamed frames are recorded to RecordFile.")
+
+    RecordFile = attribute(label = "Record file", unit = "",
+                           display_level=DispLevel.OPERATOR,
+                           dtype = str, access = AttrWriteType.READ,
+                           doc = "File of the current or last recording.")
+
+    RecordedFrames = attribute(label = "Recorded frames", unit = "frames",
+                               display_level=DispLevel.OPERATOR,
+                               dtype = int, access = AttrWriteType.READ,
+                               doc = "Number of frames written by the current or last recording.")
+
+    RecordDroppedFrames = attribute(label = "Record dropped frames", unit = "frames",
+                                    display_level=DispLevel.EXPERT,
+                                    dtype = int, access = AttrWriteType.READ,
+                                    doc = "Number of frames the recorder dropped because its queue was full.")
+
+    #call statistics
+    CallStatistics = attribute(label = "Call statistics", unit = "",
+                               display_level=DispLevel.EXPERT,
+                               dtype=[str,],
+                               max_dim_x=lib_instrumentation.MAX_OPERATIONS, max_dim_y=0,
+                               access = AttrWriteType.READ,
+                               doc = "One line per driver function: calls, errors and mean, median, 99th percentile and maximum latency in micro seconds.")
+
+    CallCount = attribute(label = "Call count", unit = "calls",
+                          display_level=DispLevel.EXPERT,
+                          dtype = int, access = AttrWriteType.READ,
+                          doc = "Number of driver function calls since start or the last ResetCallStatistics.")
+
+    CallErrors = attribute(label = "Call errors", unit = "calls",
+                           display_level=DispLevel.EXPERT,
+                           dtype = int, access = AttrWriteType.READ,
+                           doc = "Number of driver function calls that raised an error.")
+
+    CallHistograms = attribute(label = "Call latency histograms", unit = "calls",
+                               display_level=DispLevel.EXPERT,
+                               dtype=((int,),),
+                               max_dim_x=lib_instrumentation.NUMBER_OF_BUCKETS,
+                               max_dim_y=lib_instrumentation.MAX_OPERATIONS,
+                               access = AttrWriteType.READ,
+                               doc = "Latency histogram of each driver function, one row per line of CallStatistics, buckets as in CallHistogramEdges.")
+
+    CallHistogramEdges = attribute(label = "Call histogram edges", unit = "micro seconds",
+                                   display_level=DispLevel.EXPERT,
+                                   dtype=[float,],
+                                   max_dim_x=lib_instrumentation.NUMBER_OF_BUCKETS, max_dim_y=0,
+                                   access = AttrWriteType.READ,
+                                   doc = "Upper latency limit of every CallHistograms bucket.")
+
+
+
+    def init_device(self):
+        Device.init_device(self)
+        self.ring = None
+        self.acquisition = None
+        self.pusher = None
+        self.event_min_interval = 0.0
+        self.averager = None
+        self.host_averaging = False
+        self.host_scans_to_average = 10
+        self.target_snr = 0.0
+        self.stream_frame = None
+        self.dark_subtraction = False
+        self.dark_key = None
+        self.calibration = None
+        self.wavelengths = None
+        self.published_wavelengths = None
+        self.bands = []
+        self.band_pixels = None
+        self.peak_window = []
+        self.peak_pixels = None
+        self.features = None
+        self.frame_cache = None
+        self.host_nonlinearity = False
+        self.host_stray_light = False
+        self.stream_scratch = None
+        self.darks = lib_darks.DarkLibrary(self.dark_library_size, self.dark_library_path or None)
+        self.burst = numpy.zeros((0, 0))
+        self.burst_timestamps = numpy.zeros(0)
+        self.roi = (0, None)
+        self.binning = 1
+        self.auto_expose_target = 0.8
+        self.auto_expose_probes = 0
+        self.recorder = None
+        #created once: Init reuses the driver buffers of the wrapper
+        if getattr(self, "Spectrometer", None) is None:
+            self.Spectrometer = OceansOpticsWrapper()
+        self.set_state(PyTango.DevState.INIT)
+        self.set_status("Device in init!")
+        try:
+            self.Spectrometer.OpenSpectrometer(self.serial_port)
+            if self.Spectrometer.GetDeviceIndex() == -1:
+                raise ValueError("No spectrometer with serial number %s found." %self.serial_port)
+            self.calibration = self.Spectrometer.GetCalibrationCoefficients()
+            self.update_settings()
+            self.update_feature_pixels()
+            self.set_change_event("Spectrum", True, False)
+            self.set_data_ready_event("Spectrum", True)
+            for name in ("BandIntegrals", "PeakCentroid", "PeakHeight", "PeakWidth"):
+                self.set_change_event(name, True, False)
+            self.set_state(PyTango.DevState.ON)
+            self.set_status("Device is ON!")
+            print("Device is now turned on")
+        except Exception:
+            print("Error Device could not initialize")
+            self.set_state(DevState.FAULT)
+            self.set_status("Device could not initialize!")
+
+    def delete_device(self):
+        self.stop_stream()
+        self.stop_recording()
+
+
+    def read_Index(self):
+        return self.Spectrometer.GetDeviceIndex()
+
+    def read_IntegrationTime(self):
+        return self.Spectrometer.GetIntegrationTime()
+
+    def write_IntegrationTime(self, T):
+        self.Spectrometer.SetIntegrationTime(T)
+        self.update_settings()
+
+    def read_DarkCorrection(self):
+        return bool(self.Spectrometer.GetCorrectForElectricalDark())
+
+    def write_DarkCorrection(self, onoff):
+        self.Spectrometer.SetCorrectForElectricalDark(onoff)
+        self.update_settings()
+
+    def read_NonLinearityCorrection(self):
+        return bool(self.Spectrometer.GetCorrectForDetectorNonlinearity())
+
+    def write_NonLinearityCorrection(self, onoff):
+        self.Spectrometer.SetCorrectForDetectorNonlinearity(onoff)
+        if onoff:
+            self.host_nonlinearity = False
+        self.update_settings()
+
+    def read_StrayLightCorrection(self):
+        return bool(self.Spectrometer.GetCorrectForStrayLight())
+
+
+
+    def read_ScansToAverage(self):
+        return self.Spectrometer.GetScansToAverage()
+
+    def write_ScansToAverage(self, number):
+        self.Spectrometer.SetScansToAverage(number)
+        self.update_settings()
+
+
+
+
+    def read_IsSpectrumValid(self):
+        return self.Spectrometer.IsSpectrumValid()
+
+    def read_IsSaturated(self):
+        return self.Spectrometer.IsSaturated()
+
+   
+
+    def read_Spectrum(self):
+        return self.output(self.current_frame("Spectrum"))
+
+    def read_RawSpectrum(self):
+        if self.read_Streaming():
+            frame = self.streamed_frame()[0]
+        else:
+            frame = self.Spectrometer.GetSpectrum()
+        return self.output(frame, dtype=numpy.uint32)
+
+    def read_Wavelengths(self):
+        #published axis, recomputed only when the calibration, ROI or binning change
+        key = (self.roi, self.binning)
+        if self.published_wavelengths is None or self.published_wavelengths[0] != key:
+            self.published_wavelengths = (key, self.output(self.wavelength_axis(), numpy.mean, numpy.float64))
+        return self.published_wavelengths[1]
+
+    def read_CalibrationCoefficients(self):
+        if self.calibration is None:
+            return numpy.zeros(0)
+        return self.calibration["wl_coef"]
+
+    def read_Streaming(self):
+        return self.acquisition is not None and self.acquisition.is_alive()
+
+    def read_BufferDepth(self):
+        return self.buffer_depth
+
+    def read_BufferFill(self):
+        if self.ring is None:
+            return 0
+        return self.ring.fill_level()
+
+    def read_FrameNumber(self):
+        if self.ring is None:
+            return 0
+        return self.ring.count
+
+    def read_FrameTimestamp(self):
+        latest = None if self.ring is None else self.ring.latest()
+        if latest is None:
+            return 0.0
+        return latest[1]
+
+    def read_EventMinInterval(self):
+        return self.event_min_interval*1000.0
+
+    def write_EventMinInterval(self, interval):
+        self.event_min_interval = interval/1000.0
+        if self.pusher is not None:
+            self.pusher.min_interval = self.event_min_interval
+
+    def read_DroppedEvents(self):
+        if self.pusher is None:
+            return 0
+        return self.pusher.dropped
+
+    def read_HostAveraging(self):
+        return self.host_averaging
+
+    def write_HostAveraging(self, onoff):
+        self.host_averaging = onoff
+        if self.averager is not None:
+            self.averager.reset()
+
+    def read_HostScansToAverage(self):
+        return self.host_scans_to_average
+
+    def write_HostScansToAverage(self, number):
+        self.host_scans_to_average = number
+        if self.averager is not None:
+            self.averager.target_count = number
+
+    def read_TargetSNR(self):
+        return self.target_snr
+
+    def write_TargetSNR(self, snr):
+        self.target_snr = snr
+        if self.averager is not None:
+            self.averager.target_snr = snr
+
+    def read_AveragedScans(self):
+        if self.averager is None:
+            return 0
+        return self.averager.count
+
+    def read_AveragingDone(self):
+        return self.averager is not None and self.averager.done()
+
+    def read_SNR(self):
+        if self.averager is None:
+            return 0.0
+        return self.averager.snapshot()[3]
+
+    def read_SpectrumStdDev(self):
+        if self.averager is None:
+            return numpy.zeros(0)
+        #the standard deviation of a binned sum is the root of the summed variances
+        return numpy.sqrt(self.output(self.averager.snapshot()[1]**2))
+
+    def read_DarkSubtraction(self):
+        return self.dark_subtraction
+
+    def write_DarkSubtraction(self, onoff):
+        self.dark_subtraction = onoff
+
+    def read_DarkAvailable(self):
+        return self.dark_key in self.darks
+
+    def read_DarkLibrarySize(self):
+        return len(self.darks)
+
+    def read_HostNonLinearityCorrection(self):
+        return self.host_nonlinearity
+
+    def write_HostNonLinearityCorrection(self, onoff):
+        if onoff:
+            #never correct twice
+            self.Spectrometer.SetCorrectForDetectorNonlinearity(False)
+            self.update_settings()
+        self.host_nonlinearity = onoff
+
+    def read_HostStrayLightCorrection(self):
+        return self.host_stray_light
+
+    def write_HostStrayLightCorrection(self, onoff):
+        self.host_stray_light = onoff
+
+    def read_Burst(self):
+        return self.output(self.burst)
+
+    def read_BurstTimestamps(self):
+        return self.burst_timestamps
+
+    def read_RoiPixels(self):
+        start, stop = self.roi
+        if stop is None:
+            stop = self.Spectrometer.GetNumberOfPixels() - 3
+        return [start, stop]
+
+    def write_RoiPixels(self, pixels):
+        nr_of_pixels = self.Spectrometer.GetNumberOfPixels() - 3
+        start, stop = int(pixels[0]), int(pixels[1])
+        if not 0 <= start < stop <= nr_of_pixels:
+            raise ValueError("ROI must satisfy 0 <= first < last + 1 <= %d." %nr_of_pixels)
+        if stop - start < self.binning:
+            raise ValueError("ROI must be at least Binning (%d) pixels wide." %self.binning)
+        self.roi = (start, stop)
+
+    def read_RoiWavelengths(self):
+        wavelengths = self.wavelength_axis()
+        start, stop = self.read_RoiPixels()
+        return [wavelengths[start], wavelengths[stop - 1]]
+
+    def write_RoiWavelengths(self, limits):
+        wavelengths = self.wavelength_axis()
+        start = lib_processing.wavelength_to_pixel(wavelengths, min(limits))
+        stop = lib_processing.wavelength_to_pixel(wavelengths, max(limits))
+        if stop < len(wavelengths) and wavelengths[stop] == max(limits):
+            stop += 1
+        self.write_RoiPixels([start, stop])
+
+    def read_Binning(self):
+        return self.binning
+
+    def write_Binning(self, binning):
+        start, stop = self.read_RoiPixels()
+        if not 1 <= binning <= stop - start:
+            raise ValueError("Binning must be between 1 and the %d pixels of the ROI." %(stop - start))
+        self.binning = binning
+
+    def read_Bands(self):
+        return self.bands
+
+    def write_Bands(self, limits):
+        if len(limits) % 2 or len(limits) > 2*self.MAX_BANDS:
+            raise ValueError("Bands must be up to %d pairs of [first, last] wavelengths." %self.MAX_BANDS)
+        limits = list(limits)
+        for first, last in zip(limits[::2], limits[1::2]):
+            if not first < last:
+                raise ValueError("The first wavelength of a band must be below the last one.")
+        self.bands = limits
+        self.update_feature_pixels()
+
+    def read_BandIntegrals(self):
+        return self.current_features("BandIntegrals")[0]
+
+    def read_PeakWindow(self):
+        return self.peak_window
+
+    def write_PeakWindow(self, limits):
+        if len(limits) not in (0, 2):
+            raise ValueError("PeakWindow must be empty or [first, last] wavelength.")
+        self.peak_window = sorted(limits)
+        self.update_feature_pixels()
+
+    def read_PeakCentroid(self):
+        return self.current_features("PeakCentroid")[1]
+
+    def read_PeakHeight(self):
+        return self.current_features("PeakHeight")[2]
+
+    def read_PeakWidth(self):
+        return self.current_features("PeakWidth")[3]
+
+    def read_AutoExposeTarget(self):
+        return self.auto_expose_target
+
+    def write_AutoExposeTarget(self, fraction):
+        self.auto_expose_target = fraction
+
+    def read_AutoExposeProbes(self):
+        return self.auto_expose_probes
+
+    def read_Recording(self):
+        return self.recorder is not None and not self.recorder.stopped
+
+    def read_RecordFile(self):
+        if self.recorder is None:
+            return ""
+        return self.recorder.path
+
+    def read_RecordedFrames(self):
+        if self.recorder is None:
+            return 0
+        return self.recorder.recorded
+
+    def read_RecordDroppedFrames(self):
+        if self.recorder is None:
+            return 0
+        return self.recorder.dropped
+
+    def read_CallStatistics(self):
+        return self.Spectrometer.instrumentation.statistics()
+
+    def read_CallCount(self):
+        return self.Spectrometer.instrumentation.totals()[0]
+
+    def read_CallErrors(self):
+        return self.Spectrometer.instrumentation.totals()[1]
+
+    def read_CallHistograms(self):
+        histograms = numpy.array(self.Spectrometer.instrumentation.histograms(), dtype=int)
+        return histograms.reshape(-1, lib_instrumentation.NUMBER_OF_BUCKETS)
+
+    def read_CallHistogramEdges(self):
+        return lib_instrumentation.bucket_edges()
+
+
+
+
+    @command
+    def CloseSpectrometer(self):
+        self.stop_stream()
+        self.Spectrometer.CloseSpectrometer()
+        self.set_state(PyTango.DevState.OFF)
+        self.set_status("Device is OFF!")
+    @command
+    def StopAveraging(self):
+        self.Spectrometer.StopAveraging()
+
+    @command
+    def StartStream(self):
+        """Acquire spectra back to back into the ring buffer in a worker thread."""
+        #threads left by an average that finished early
+        self.stop_stream()
+        nr_of_pixels = self.Spectrometer.GetNumberOfPixels() - 3
+        self.ring = lib_acquisition.SpectrumRingBuffer(self.buffer_depth, nr_of_pixels)
+        if self.averager is None or self.averager.mean.shape != (nr_of_pixels,):
+            self.averager = lib_acquisition.StreamingAverager(nr_of_pixels)
+        self.averager.target_count = self.host_scans_to_average
+        self.averager.target_snr = self.target_snr
+        self.averager.reset()
+        self.stream_frame = numpy.zeros(nr_of_pixels)
+        self.stream_scratch = numpy.zeros(nr_of_pixels)
+        self.pusher = lib_acquisition.EventPusher(self.push_frame, self.event_min_interval)
+        self.pusher.start()
+        self.acquisition = lib_acquisition.AcquisitionThread(
+            lambda out: self.Spectrometer.GetSpectrum(out=out),
+            self.ring, on_frame=self.new_frame, on_error=self.stream_error)
+        self.acquisition.start()
+        self.set_state(DevState.RUNNING)
+        self.set_status("Acquisition stream running!")
+
+    def is_StartStream_allowed(self):
+        return self.get_state() == DevState.ON
+
+    @command
+    def StopStream(self):
+        self.stop_stream()
+
+    @command
+    def RestartAveraging(self):
+        """Discard the host average and start a new one, starting the stream if needed."""
+        if self.read_Streaming():
+            self.averager.reset()
+        else:
+            self.stop_stream()
+            self.StartStream()
+
+    def is_RestartAveraging_allowed(self):
+        return self.get_state() in (DevState.ON, DevState.RUNNING)
+
+    @command
+    def AcquireDark(self):
+        """Acquire a dark frame with the current settings and store it in the dark library. Close the light path first."""
+        self.darks.put(self.dark_key, self.acquire_raw_frame())
+
+    def is_AcquireDark_allowed(self):
+        return self.get_state() in (DevState.ON, DevState.RUNNING)
+
+    @command
+    def ClearDarks(self):
+        self.darks.clear()
+
+    @command(dtype_in=[float,], doc_in="[number of frames, interval between frame starts in s (0 = back to back)]")
+    def AcquireBurst(self, argin):
+        """Acquire a series of frames server-side into the Burst image attribute."""
+        n = int(argin[0])
+        interval = argin[1] if len(argin) > 1 else 0.0
+        if not 0 < n <= self.MAX_BURST_FRAMES:
+            raise ValueError("Number of frames must be between 1 and %d." %self.MAX_BURST_FRAMES)
+        nr_of_pixels = self.Spectrometer.GetNumberOfPixels() - 3
+        if self.burst.shape != (n, nr_of_pixels):
+            self.burst = numpy.zeros((n, nr_of_pixels))
+            self.burst_timestamps = numpy.zeros(n)
+        if self.read_Streaming():
+            #take consecutive frames of the running stream
+            last = [self.ring.count]
+            timeout = self.frame_timeout()
+            def acquire(out):
+                last[0] = self.ring.read_newer(last[0], out, timeout)
+                if last[0] == 0:
+                    raise RuntimeError("Timeout while waiting for a new frame.")
+        else:
+            def acquire(out):
+                self.Spectrometer.GetSpectrum(out=out)
+        lib_acquisition.acquire_burst(acquire, self.burst, self.burst_timestamps, interval)
+        for frame in self.burst:
+            self.correct_frame(frame)
+
+    def is_AcquireBurst_allowed(self):
+        return self.get_state() in (DevState.ON, DevState.RUNNING)
+
+    @command(dtype_out=int, doc_out="Integration time found in micro seconds")
+    def AutoExpose(self):
+        """Set the longest integration time whose peak stays below AutoExposeTarget of the maximum intensity."""
+        streaming = self.read_Streaming()
+        self.stop_stream()
+        scans_to_average = self.Spectrometer.GetScansToAverage()
+        self.Spectrometer.SetScansToAverage(1)
+        try:
+            t_min = self.Spectrometer.GetMinimumIntegrationTime()
+            t_max = self.Spectrometer.GetMaximumIntegrationTime()
+            #probe at a tenth of the current time, then extrapolate
+            t, self.auto_expose_probes = lib_acquisition.auto_expose(
+                self.Spectrometer.GetSpectrum, self.Spectrometer.SetIntegrationTime,
+                t_min, t_max, self.Spectrometer.GetMaximumIntensity(),
+                self.auto_expose_target, self.Spectrometer.GetIntegrationTime()//10)
+            self.Spectrometer.SetIntegrationTime(t)
+        finally:
+            self.Spectrometer.SetScansToAverage(scans_to_average)
+            self.update_settings()
+            if streaming:
+                self.StartStream()
+        return t
+
+    def is_AutoExpose_allowed(self):
+        return self.get_state() in (DevState.ON, DevState.RUNNING)
+
+    @command(dtype_in=str, doc_in="File to record to (HDF5, or raw file + index without h5py)")
+    def StartRecording(self, path):
+        """Record every streamed raw frame with its timestamp and settings, starting the stream if needed."""
+        self.stop_recording()
+        metadata = {"serial_number": self.serial_port,
+                    "dark_subtraction": self.dark_subtraction,
+                    "host_nonlinearity_correction": self.host_nonlinearity,
+                    "host_stray_light_correction": self.host_stray_light}
+        if self.calibration is not None:
+            #enough to correct the raw frames later, see lib_processing.correct_frames
+            metadata.update(self.calibration)
+        dark = self.darks.get(self.dark_key)
+        if dark is not None:
+            metadata["dark"] = dark
+        self.recorder = lib_recorder.SpectrumRecorder(
+            path, self.Spectrometer.GetNumberOfPixels() - 3,
+            self.wavelength_axis(), metadata,
+            self.record_queue_size, self.record_compression)
+        self.recorder.start()
+        if not self.read_Streaming():
+            self.StartStream()
+
+    def is_StartRecording_allowed(self):
+        return self.get_state() in (DevState.ON, DevState.RUNNING)
+
+    @command
+    def StopRecording(self):
+        self.stop_recording()
+
+    @command
+    def ResetCallStatistics(self):
+        self.Spectrometer.instrumentation.reset()
+
+    @command
+    def ReloadCalibration(self):
+        """Read the calibration coefficients from the spectrometer again and recompute the wavelength axis."""
+        self.calibration = self.Spectrometer.GetCalibrationCoefficients()
+        self.wavelengths = None
+        self.published_wavelengths = None
+        self.update_feature_pixels()
+
+    def is_ReloadCalibration_allowed(self):
+        return self.get_state() == DevState.ON
+
+    #settings and host-side corrections
+    def update_settings(self):
+        """Cache the acquisition settings that select the dark frame."""
+        self.dark_key = lib_darks.DarkLibrary.make_key(
+            self.Spectrometer.GetIntegrationTime(),
+            self.Spectrometer.GetScansToAverage(),
+            self.Spectrometer.GetCorrectForElectricalDark(),
+            self.Spectrometer.GetCorrectForDetectorNonlinearity())
+        self.frame_cache = None
+
+    def correct_frame(self, frame, out=None, scratch=None):
+        """Apply the host-side corrections to a raw frame, in place unless out is given.
+        scratch is an optional preallocated work array for the nonlinearity correction."""
+        if out is None:
+            out = frame
+        else:
+            numpy.copyto(out, frame)
+        if self.dark_subtraction:
+            self.darks.subtract(out, self.dark_key)
+        if self.calibration is not None:
+            if self.host_nonlinearity:
+                lib_processing.correct_nonlinearity(out, self.calibration["nl_coef"], scratch=scratch)
+            if self.host_stray_light:
+                lib_processing.correct_stray_light(out, self.calibration["stray_light"])
+        return out
+
+    def wavelength_axis(self):
+        """Wavelengths of the published pixels, computed once per calibration
+        from the wavelength polynomial (read-only array)."""
+        if self.wavelengths is None:
+            nr_of_pixels = self.Spectrometer.GetNumberOfPixels()
+            if self.calibration is not None and numpy.any(self.calibration["wl_coef"]):
+                #the driver drops the first three pixels of every frame
+                self.wavelengths = lib_processing.wavelength_axis(self.calibration["wl_coef"], 3, nr_of_pixels)
+            else:
+                self.wavelengths = self.Spectrometer.GetWavelengths()
+                self.wavelengths.flags.writeable = False
+        return self.wavelengths
+
+    def current_frame(self, reader=None):
+        """The corrected full resolution frame Spectrum publishes: the host
+        average, the newest streamed frame or an acquisition (see acquired_frame)."""
+        if self.host_averaging and self.averager is not None and self.averager.count > 0:
+            return self.averager.snapshot()[0]
+        if self.read_Streaming():
+            return self.correct_frame(self.streamed_frame()[0])
+        return self.acquired_frame(reader)["frame"]
+
+    def streamed_frame(self):
+        """(raw frame, timestamp, sequence number) of the newest streamed frame.
+        Before the first frame is committed this waits for it: the driver
+        must not be called while the acquisition thread uses it."""
+        if not self.ring.wait_for(1, self.frame_timeout()):
+            raise RuntimeError("Timeout while waiting for the first frame of the stream.")
+        return self.ring.latest()
+
+    def acquired_frame(self, reader):
+        """Cache entry (frame, features, readers) of the last acquisition
+        outside the stream. The attributes read for one panel refresh share
+        it: a new frame is only acquired when reader (an attribute name) has
+        already read the cached one."""
+        cache = self.frame_cache
+        if cache is None or reader is None or reader in cache["readers"]:
+            cache = {"frame": self.correct_frame(self.Spectrometer.GetSpectrum()),
+                     "features": None, "readers": set()}
+            self.frame_cache = cache
+        cache["readers"].add(reader)
+        return cache
+
+    def update_feature_pixels(self):
+        """Translate Bands and PeakWindow to pixel ranges of the wavelength axis."""
+        wavelengths = self.wavelength_axis()
+        self.band_pixels = lib_processing.band_pixels(wavelengths, self.bands)
+        if self.peak_window:
+            starts, stops = lib_processing.band_pixels(wavelengths, self.peak_window)
+            self.peak_pixels = (starts[0], stops[0])
+        else:
+            self.peak_pixels = (0, len(wavelengths))
+        self.features = None
+        if self.frame_cache is not None:
+            self.frame_cache["features"] = None
+
+    def compute_features(self, frame):
+        """Band integrals and peak centroid, height and width of a full resolution frame."""
+        wavelengths = self.wavelength_axis()
+        integrals = lib_processing.band_integrals(frame, wavelengths, *self.band_pixels)
+        return (integrals,) + lib_processing.peak_features(frame, wavelengths, *self.peak_pixels)
+
+    def current_features(self, reader=None):
+        """Features of the newest streamed frame, of the host average, or of
+        the acquired frame, computed once per frame."""
+        if self.read_Streaming():
+            features = self.features
+            if features is None:
+                #Bands or PeakWindow changed since the last frame of the stream
+                features = self.compute_features(self.current_frame())
+            return features
+        if self.host_averaging and self.averager is not None and self.averager.count > 0:
+            return self.compute_features(self.averager.snapshot()[0])
+        cache = self.acquired_frame(reader)
+        if cache["features"] is None:
+            cache["features"] = self.compute_features(cache["frame"])
+        return cache["features"]
+
+    def output(self, data, reduce=numpy.sum, dtype=numpy.float32):
+        """Region of interest, binning and dtype of a frame (or the rows of a burst) as published."""
+        data = lib_processing.roi_bin(data, self.roi[0], self.roi[1], self.binning, reduce)
+        return lib_processing.cast(data, dtype)
+
+    def acquire_raw_frame(self):
+        """Return a raw frame whose acquisition started after this call."""
+        if self.read_Streaming():
+            #the frame in flight may have started before the call
+            sequence = self.ring.count + 2
+            if not self.ring.wait_for(sequence, self.frame_timeout()):
+                raise RuntimeError("Timeout while waiting for a new frame.")
+            return self.ring.latest()[0]
+        return self.Spectrometer.GetSpectrum()
+
+    #acquisition stream helpers
+    def frame_timeout(self):
+        """Seconds to wait for a streamed frame: twice the acquisition time plus 1 s."""
+        return 2*self.dark_key[0]*self.dark_key[1]/1e6 + 1.0
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.stop()
+    def stop_stream(self):
+        if self.acquisition is not None:
+            self.acquisition.stop()
+            self.acquisition = None
+            if self.get_state() == DevState.RUNNING:
+                self.set_state(DevState.ON)
+                self.set_status("Device is ON!")
+        if self.pusher is not None:
+            self.pusher.stop()
+
+    def new_frame(self, frame, timestamp, sequence):
+        if self.recorder is not None:
+            self.recorder.record(frame, timestamp, sequence, self.dark_key)
+        frame = self.correct_frame(frame, self.stream_frame, self.stream_scratch)
+        finished = False
+        if self.host_averaging:
+            if not self.averager.update(frame):
+                return
+            frame = self.averager.mean
+            finished = self.averager.done()
+        self.features = self.compute_features(frame)
+        self.pusher.offer(self.output(frame), timestamp, sequence, self.features)
+        if finished:
+            #early stop: no more frames are needed for this average. The
+            #pusher exits once the final average is pushed, the recorder once
+            #the frames it has queued are written.
+            self.acquisition.stopped.set()
+            self.pusher.stop(0, flush=True)
+            self.stop_recording()
+            self.set_state(DevState.ON)
+            self.set_status("Averaging finished after %d scans." %self.averager.count)
+
+    def push_frame(self, frame, timestamp, sequence, features):
+        self.push_change_event("Spectrum", frame, timestamp, AttrQuality.ATTR_VALID)
+        self.push_data_ready_event("Spectrum", sequence)
+        if features is not None:
+            for name, value in zip(("BandIntegrals", "PeakCentroid", "PeakHeight", "PeakWidth"), features):
+                self.push_change_event(name, value, timestamp, AttrQuality.ATTR_VALID)
+
+    def stream_error(self, error):
+        print("Acquisition stream stopped: %s" %error)
+        self.set_state(DevState.FAULT)
+        self.set_status("Acquisition stream stopped: %s" %error)
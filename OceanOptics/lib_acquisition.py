@@ -0,0 +1,309 @@
+import threading
+import time
+
+import numpy
+
+
+
+class SpectrumRingBuffer:
+    """Fixed size ring buffer of spectra with timestamps and sequence numbers.
+
+    All memory is allocated once. The acquisition thread writes into the slot
+    after the newest frame and commits it, so readers only ever see complete
+    frames and never the one being written.
+    """
+
+    def __init__(self, depth, nr_of_pixels):
+        if depth < 2:
+            raise ValueError("Ring buffer depth must be at least 2.")
+        self.depth = depth
+        self.frames = numpy.zeros((depth, nr_of_pixels))
+        self.timestamps = numpy.zeros(depth)
+        self.sequence = numpy.zeros(depth, dtype=numpy.int64)
+        self.head = -1          #slot of the newest complete frame
+        self.count = 0          #number of frames committed so far
+        self.condition = threading.Condition()
+
+    def next_slot(self):
+        return (self.head + 1) % self.depth
+
+    def commit(self, slot, timestamp):
+        """Mark the frame in slot as complete and return its sequence number."""
+        with self.condition:
+            self.count += 1
+            self.timestamps[slot] = timestamp
+            self.sequence[slot] = self.count
+            self.head = slot
+            self.condition.notify_all()
+        return self.count
+
+    def latest(self):
+        """Return (frame, timestamp, sequence number) of the newest complete
+        frame, or None if nothing has been acquired yet. The frame is a copy."""
+        with self.condition:
+            if self.head < 0:
+                return None
+            return (self.frames[self.head].copy(),
+                    float(self.timestamps[self.head]),
+                    int(self.sequence[self.head]))
+
+    def wait_for(self, sequence, timeout=None):
+        """Block until the frame with the given sequence number is committed.
+        Returns False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.count < sequence:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def read_newer(self, sequence, out, timeout=None):
+        """Wait for a frame newer than sequence and copy it to out. Returns its
+        sequence number, or 0 on timeout."""
+        if not self.wait_for(sequence + 1, timeout):
+            return 0
+        with self.condition:
+            numpy.copyto(out, self.frames[self.head])
+            return int(self.sequence[self.head])
+
+    def fill_level(self):
+        return min(self.count, self.depth)
+
+
+
+def acquire_burst(acquire, frames, timestamps, interval=0.0):
+    """Fill the rows of the preallocated 2D array frames with consecutive
+    spectra, starting one every interval seconds (back to back if 0), and
+    timestamps with their acquisition times. acquire(out) fills one row."""
+    start = time.time()
+    for i in range(len(frames)):
+        delay = start + i*interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        acquire(frames[i])
+        timestamps[i] = time.time()
+
+
+
+def auto_expose(acquire, set_integration_time, t_min, t_max, max_counts,
+                target=0.8, t_start=None, max_probes=8):
+    """Search the longest integration time (usec) whose peak counts stay
+    below target*max_counts. The first probe uses t_start (default t_min);
+    each following time is extrapolated linearly from the signal above the
+    baseline of the previous probe, or cut tenfold after a saturated probe.
+    The search ends when the extrapolation converges, hits a limit or after
+    max_probes acquisitions. acquire() returns one raw frame.
+    Returns (integration time, number of probes used)."""
+    goal = target*max_counts
+    t = int(min(max(t_start or t_min, t_min), t_max))
+    best = t_min
+    probes = 0
+    while probes < max_probes:
+        set_integration_time(t)
+        frame = acquire()
+        probes += 1
+        peak = numpy.max(frame)
+        if peak >= 0.98*max_counts:
+            if t == t_min:
+                return t_min, probes
+            t_next = t/10.0
+        else:
+            if peak <= goal:
+                best = max(best, t)
+            baseline = numpy.percentile(frame, 5)
+            if peak - baseline <= 0:
+                t_next = t*10.0
+            else:
+                t_next = t*(goal - baseline)/(peak - baseline)
+        t_next = int(min(max(t_next, t_min), t_max))
+        if t_next == t or (peak <= goal and abs(t_next - t) <= 0.02*t):
+            return (t if peak <= goal else best), probes
+        t = t_next
+    return best, probes
+
+
+
+class AcquisitionThread(threading.Thread):
+    """Worker thread acquiring spectra back to back into a SpectrumRingBuffer.
+
+    acquire(out) must fill the preallocated array out with one spectrum.
+    on_frame(frame, timestamp, sequence) is called from this thread after each
+    committed frame, on_error(exception) once if acquire or on_frame fails.
+    """
+
+    def __init__(self, acquire, ring, on_frame=None, on_error=None):
+        threading.Thread.__init__(self, name="SpectrumAcquisition")
+        self.daemon = True
+        self.acquire = acquire
+        self.ring = ring
+        self.on_frame = on_frame
+        self.on_error = on_error
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            slot = self.ring.next_slot()
+            try:
+                self.acquire(self.ring.frames[slot])
+                timestamp = time.time()
+                sequence = self.ring.commit(slot, timestamp)
+                if self.on_frame is not None:
+                    self.on_frame(self.ring.frames[slot], timestamp, sequence)
+            except Exception as e:
+                self.stopped.set()
+                if self.on_error is not None:
+                    self.on_error(e)
+                return
+
+    def stop(self, timeout=None):
+        """Ask the thread to finish after the current frame and wait for it."""
+        self.stopped.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+
+
+class EventPusher(threading.Thread):
+    """Thread publishing frames to event subscribers without blocking acquisition.
+
+    offer() copies the frame into a preallocated pending buffer and returns at
+    once; data (e.g. values derived from the frame) is passed on with it. If
+    a push is still in progress, or the previous push was less than
+    min_interval seconds ago, a newer frame replaces the pending one and the
+    replaced frame is counted in dropped.
+    """
+
+    def __init__(self, push, min_interval=0.0):
+        threading.Thread.__init__(self, name="SpectrumEvents")
+        self.daemon = True
+        self.push = push            #push(frame, timestamp, sequence, data)
+        self.min_interval = min_interval
+        self.pending = numpy.zeros(0)
+        self.outgoing = numpy.zeros(0)
+        self.pending_timestamp = 0.0
+        self.pending_sequence = 0
+        self.pending_data = None
+        self.has_pending = False
+        self.pushed = 0
+        self.dropped = 0
+        self.stopped = False
+        self.flush = False
+        self.condition = threading.Condition()
+
+    def offer(self, frame, timestamp, sequence, data=None):
+        with self.condition:
+            if self.has_pending:
+                self.dropped += 1
+            if self.pending.shape != frame.shape or self.pending.dtype != frame.dtype:
+                self.pending = numpy.empty_like(frame)
+            numpy.copyto(self.pending, frame)
+            self.pending_timestamp = timestamp
+            self.pending_sequence = sequence
+            self.pending_data = data
+            self.has_pending = True
+            self.condition.notify()
+
+    def run(self):
+        last_push = 0.0
+        while True:
+            with self.condition:
+                while not self.has_pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped and not (self.flush and self.has_pending):
+                    return
+                delay = last_push + self.min_interval - time.time()
+                if delay > 0 and not self.stopped:
+                    self.condition.wait(delay)
+                    continue
+                self.pending, self.outgoing = self.outgoing, self.pending
+                timestamp = self.pending_timestamp
+                sequence = self.pending_sequence
+                data = self.pending_data
+                self.has_pending = False
+            try:
+                self.push(self.outgoing, timestamp, sequence, data)
+                self.pushed += 1
+            except Exception as e:
+                print("Could not push event for frame %d: %s" %(sequence, e))
+            last_push = time.time()
+
+    def stop(self, timeout=None, flush=False):
+        """Stop the thread, after pushing the pending frame if flush."""
+        with self.condition:
+            self.stopped = True
+            self.flush = flush
+            self.condition.notify()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+
+
+class StreamingAverager:
+    """Running per-pixel mean and variance of a stream of spectra (Welford).
+
+    All arrays are preallocated and update() is vectorised. Accumulation stops
+    once target_count frames have been added or, if target_snr is non-zero,
+    as soon as the signal to noise ratio of the mean at the brightest pixel
+    reaches target_snr.
+    """
+
+    def __init__(self, nr_of_pixels, target_count=1, target_snr=0.0):
+        self.mean = numpy.zeros(nr_of_pixels)
+        self.m2 = numpy.zeros(nr_of_pixels)
+        self.delta = numpy.zeros(nr_of_pixels)
+        self.scratch = numpy.zeros(nr_of_pixels)
+        self.target_count = target_count
+        self.target_snr = target_snr
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.mean.fill(0)
+            self.m2.fill(0)
+            self.count = 0
+
+    def update(self, frame):
+        """Add one frame. Returns False if averaging had already finished."""
+        with self.lock:
+            if self._done():
+                return False
+            self.count += 1
+            numpy.subtract(frame, self.mean, out=self.delta)
+            numpy.multiply(self.delta, 1.0/self.count, out=self.scratch)
+            self.mean += self.scratch
+            numpy.subtract(frame, self.mean, out=self.scratch)
+            self.scratch *= self.delta
+            self.m2 += self.scratch
+            return True
+
+    def done(self):
+        with self.lock:
+            return self._done()
+
+    def snapshot(self):
+        """Return copies of (mean, standard deviation, count, snr)."""
+        with self.lock:
+            return self.mean.copy(), self._stddev(), self.count, self._snr()
+
+    def _stddev(self):
+        if self.count < 2:
+            return numpy.zeros_like(self.mean)
+        return numpy.sqrt(self.m2/(self.count - 1))
+
+    def _snr(self):
+        """Signal to noise ratio of the mean at its brightest pixel."""
+        if self.count < 2:
+            return 0.0
+        peak = numpy.argmax(self.mean)
+        error = numpy.sqrt(self.m2[peak]/(self.count - 1)/self.count)
+        if error == 0:
+            return float("inf")
+        return float(self.mean[peak]/error)
+
+    def _done(self):
+        if self.count >= self.target_count:
+            return True
+        return self.target_snr > 0 and self._snr() >= self.target_snr
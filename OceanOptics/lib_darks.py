@@ -0,0 +1,93 @@
+import collections
+import glob
+import os
+import threading
+
+import numpy
+
+
+
+class DarkLibrary:
+    """Dark frames indexed by acquisition settings, with LRU eviction.
+
+    A key is (integration time, scans to average, electrical dark correction,
+    nonlinearity correction), see make_key(). When a directory is given every
+    stored dark is also saved there as a .npy file, darks found there are
+    loaded on construction, and evicted darks are removed from disk as well.
+    """
+
+    def __init__(self, capacity=32, directory=None):
+        self.capacity = capacity
+        self.directory = directory
+        self.frames = collections.OrderedDict()
+        self.lock = threading.Lock()
+        if directory:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.load()
+
+    @staticmethod
+    def make_key(integration_time, scans_to_average, dark_correction, nonlinearity_correction):
+        return (int(integration_time), int(scans_to_average),
+                int(bool(dark_correction)), int(bool(nonlinearity_correction)))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, key):
+        return key in self.frames
+
+    def get(self, key):
+        """Return the dark frame for key (marking it as recently used) or None."""
+        with self.lock:
+            frame = self.frames.pop(key, None)
+            if frame is not None:
+                self.frames[key] = frame
+            return frame
+
+    def put(self, key, frame):
+        with self.lock:
+            self.frames.pop(key, None)
+            self.frames[key] = numpy.array(frame, dtype=float)
+            if self.directory:
+                numpy.save(self.filename(key), self.frames[key])
+            while len(self.frames) > self.capacity:
+                evicted, _ = self.frames.popitem(last=False)
+                self.remove_file(evicted)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.frames):
+                self.remove_file(key)
+            self.frames.clear()
+
+    def subtract(self, frame, key, out=None):
+        """Subtract the dark frame matching key from frame, in place unless out
+        is given. Returns False, leaving frame untouched, if there is no match
+        of the right length."""
+        dark = self.get(key)
+        if dark is None or dark.shape != frame.shape:
+            return False
+        numpy.subtract(frame, dark, out=frame if out is None else out)
+        return True
+
+    #persistence
+    def filename(self, key):
+        return os.path.join(self.directory, "dark_%d_%d_%d_%d.npy" %key)
+
+    def remove_file(self, key):
+        if self.directory and os.path.exists(self.filename(key)):
+            os.remove(self.filename(key))
+
+    def load(self):
+        """Load the darks saved in the directory, oldest first."""
+        paths = glob.glob(os.path.join(self.directory, "dark_*.npy"))
+        paths.sort(key=os.path.getmtime)
+        for path in paths[-self.capacity:]:
+            fields = os.path.basename(path)[len("dark_"):-len(".npy")].split("_")
+            try:
+                key = tuple(int(field) for field in fields)
+            except ValueError:
+                continue
+            if len(key) == 4:
+                self.frames[key] = numpy.load(path)
@@ -0,0 +1,141 @@
+import numpy
+
+
+
+def roi_bin(data, start, stop, binning=1, reduce=numpy.sum):
+    """Cut the pixel range [start, stop) out of the last axis of data and
+    combine groups of binning neighbouring pixels with reduce (sum for
+    counts, mean for wavelengths). A partial group at the end is dropped.
+    Without binning the result is a view of data."""
+    roi = data[..., start:stop]
+    if binning <= 1:
+        return roi
+    n = roi.shape[-1]//binning
+    groups = roi[..., :n*binning].reshape(roi.shape[:-1] + (n, binning))
+    return reduce(groups, axis=-1)
+
+
+def wavelength_to_pixel(wavelengths, wavelength):
+    """Index of the first pixel at or above wavelength (wavelengths ascending)."""
+    return int(numpy.searchsorted(wavelengths, wavelength))
+
+
+def cast(data, dtype):
+    """Convert data to the published dtype in one vectorised step. Integer
+    dtypes are rounded and clipped to their range first."""
+    dtype = numpy.dtype(dtype)
+    if dtype.kind in "ui":
+        info = numpy.iinfo(dtype)
+        data = numpy.clip(numpy.rint(data), info.min, info.max)
+    return data.astype(dtype, copy=False)
+
+
+def correct_nonlinearity(frame, nl_coef, out=None, scratch=None):
+    """Detector nonlinearity correction: divide the counts by the polynomial
+    nl_coef[0] + nl_coef[1]*counts + ... evaluated per pixel (Horner). frame
+    should be dark subtracted. Works on a frame or a stack of frames, in
+    place unless out is given; scratch is an optional preallocated array of
+    the same shape. Pixels where the polynomial is zero are left as they are."""
+    if out is None:
+        out = frame
+    elif out is not frame:
+        numpy.copyto(out, frame)
+    if len(nl_coef) == 0:
+        return out
+    if scratch is None:
+        scratch = numpy.empty_like(out)
+    scratch.fill(nl_coef[-1])
+    for c in nl_coef[-2::-1]:
+        scratch *= out
+        scratch += c
+    numpy.divide(out, scratch, out=out, where=scratch != 0)
+    return out
+
+
+def correct_stray_light(frame, stray_light, out=None):
+    """Stray light correction: the stray light coefficient is the fraction
+    of the mean signal scattered evenly over the detector, which is
+    subtracted from every pixel. Works on a frame or a stack of frames, in
+    place unless out is given."""
+    if out is None:
+        out = frame
+    level = stray_light*numpy.mean(frame, axis=-1, keepdims=True)
+    numpy.subtract(frame, level, out=out)
+    return out
+
+
+def correct_frames(frames, calibration, dark=None, nonlinearity=True, stray_light=True):
+    """Apply the host-side corrections to recorded raw frames after the fact.
+    calibration is a coefficient snapshot (see
+    OceansOpticsCoefficientsWrapper.Snapshot, stored in recordings as
+    nl_coef and stray_light) and dark an optional dark frame. Returns a
+    corrected float64 copy."""
+    out = numpy.array(frames, dtype=float)
+    if dark is not None:
+        out -= dark
+    if nonlinearity:
+        correct_nonlinearity(out, calibration["nl_coef"])
+    if stray_light:
+        correct_stray_light(out, calibration["stray_light"])
+    return out
+
+
+def wavelength_axis(wl_coef, start, stop):
+    """Wavelengths of the pixels start..stop-1 from the wavelength polynomial
+    (intercept, first, second, third order coefficient), as a read-only array."""
+    axis = numpy.polyval(numpy.asarray(wl_coef, dtype=float)[::-1],
+                         numpy.arange(start, stop, dtype=float))
+    axis.flags.writeable = False
+    return axis
+
+
+def band_pixels(wavelengths, bands):
+    """Pixel ranges [start, stop) covering the wavelength bands, given as
+    (first, last) pairs (wavelengths ascending). Returns two index arrays."""
+    bands = numpy.asarray(bands, dtype=float).reshape(-1, 2)
+    n = len(wavelengths)
+    starts = numpy.clip(numpy.searchsorted(wavelengths, bands[:, 0]), 0, n - 1)
+    stops = numpy.clip(numpy.searchsorted(wavelengths, bands[:, 1], side="right"), 1, n)
+    return starts, numpy.maximum(stops, starts + 1)
+
+
+def band_integrals(frame, wavelengths, starts, stops):
+    """Trapezoidal integrals of frame over wavelength for every pixel range
+    [starts[k], stops[k]), all taken from one cumulative sum."""
+    steps = 0.5*(frame[1:] + frame[:-1])*numpy.diff(wavelengths)
+    cumulative = numpy.concatenate(([0.0], numpy.cumsum(steps)))
+    return cumulative[stops - 1] - cumulative[starts]
+
+
+def peak_features(frame, wavelengths, start=0, stop=None):
+    """Centroid, height and FWHM of the highest peak in the pixel range
+    [start, stop). The height is taken above the minimum of the range and
+    the half maximum crossings are interpolated linearly; the centroid is
+    the intensity weighted wavelength of the pixels above half maximum.
+    The width is nan if the peak does not drop to half maximum on both
+    sides within the range."""
+    f = frame[start:stop]
+    w = wavelengths[start:stop]
+    nan = float("nan")
+    if len(f) < 3:
+        return nan, nan, nan
+    i = int(numpy.argmax(f))
+    baseline = numpy.min(f)
+    height = f[i] - baseline
+    if height <= 0:
+        return nan, 0.0, nan
+    half = baseline + 0.5*height
+    below = f < half
+    left = numpy.nonzero(below[:i])[0]
+    right = numpy.nonzero(below[i:])[0]
+    width = nan
+    if len(left) and len(right):
+        l, r = left[-1], i + right[0]
+        w_left = w[l] + (half - f[l])*(w[l + 1] - w[l])/(f[l + 1] - f[l])
+        w_right = w[r - 1] + (half - f[r - 1])*(w[r] - w[r - 1])/(f[r] - f[r - 1])
+        width = float(w_right - w_left)
+    l = left[-1] + 1 if len(left) else 0
+    r = i + right[0] if len(right) else len(f)
+    weights = f[l:r] - baseline
+    centroid = float(numpy.dot(w[l:r], weights)/numpy.sum(weights))
+    return centroid, float(height), width
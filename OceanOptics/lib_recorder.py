@@ -0,0 +1,157 @@
+import json
+import threading
+
+import numpy
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+#names of the per frame settings columns, see lib_darks.DarkLibrary.make_key
+SETTINGS_COLUMNS = ["integration_time", "scans_to_average",
+                    "dark_correction", "nonlinearity_correction"]
+
+
+
+class SpectrumRecorder(threading.Thread):
+    """Writer thread streaming frames to disk.
+
+    With h5py the frames go to a chunked, optionally compressed HDF5 file with
+    the datasets frames, timestamps, sequence, settings and wavelengths.
+    Without h5py they are appended to a raw float64 file path.raw with a
+    sidecar index path.idx (sequence, timestamp, settings per line) and the
+    metadata in path.json; see load_raw().
+
+    record() never blocks: frames are copied into a fixed pool of buffers and
+    queued for the writer. If the disk stalls and the pool runs empty, the
+    frame is dropped and counted in dropped.
+    """
+
+    def __init__(self, path, nr_of_pixels, wavelengths=None, metadata=None,
+                 queue_size=256, compression="gzip", chunk_frames=64):
+        threading.Thread.__init__(self, name="SpectrumRecorder")
+        self.daemon = True
+        self.path = path
+        self.nr_of_pixels = nr_of_pixels
+        self.wavelengths = wavelengths
+        self.metadata = metadata or {}
+        self.compression = compression or None
+        self.chunk_frames = chunk_frames
+        self.queue = queue.Queue()
+        self.free = queue.Queue()
+        for i in range(queue_size):
+            self.free.put(numpy.zeros(nr_of_pixels))
+        self.recorded = 0
+        self.dropped = 0
+        self.error = None
+        self.stopped = False
+
+    def record(self, frame, timestamp, sequence, settings):
+        if self.stopped:
+            return False
+        try:
+            buffer = self.free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return False
+        numpy.copyto(buffer, frame)
+        self.queue.put((buffer, timestamp, sequence, settings))
+        return True
+
+    def stop(self, timeout=None):
+        """Write the frames still queued, close the file and wait for the thread."""
+        self.stopped = True
+        self.queue.put(None)
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+    def run(self):
+        try:
+            if h5py is not None:
+                self.write_hdf5()
+            else:
+                self.write_raw()
+        except Exception as e:
+            self.error = e
+            self.stopped = True
+            print("Recording to %s stopped: %s" %(self.path, e))
+
+    def frames(self):
+        """Yield the queued frames until stop() is called."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            yield item
+            self.free.put(item[0])
+
+    def write_hdf5(self):
+        with h5py.File(self.path, "w") as f:
+            chunks = (self.chunk_frames, self.nr_of_pixels)
+            frames = f.create_dataset("frames", (0, self.nr_of_pixels), dtype="f8",
+                                      maxshape=(None, self.nr_of_pixels), chunks=chunks,
+                                      compression=self.compression)
+            timestamps = f.create_dataset("timestamps", (0,), dtype="f8",
+                                          maxshape=(None,), chunks=(self.chunk_frames,))
+            sequence = f.create_dataset("sequence", (0,), dtype="i8",
+                                        maxshape=(None,), chunks=(self.chunk_frames,))
+            settings = f.create_dataset("settings", (0, len(SETTINGS_COLUMNS)), dtype="i8",
+                                        maxshape=(None, len(SETTINGS_COLUMNS)),
+                                        chunks=(self.chunk_frames, len(SETTINGS_COLUMNS)))
+            settings.attrs["columns"] = json.dumps(SETTINGS_COLUMNS)
+            if self.wavelengths is not None:
+                f.create_dataset("wavelengths", data=self.wavelengths)
+            for key, value in self.metadata.items():
+                if isinstance(value, numpy.ndarray):
+                    f.create_dataset(key, data=value)
+                else:
+                    f.attrs[key] = value
+            datasets = (frames, timestamps, sequence, settings)
+            for frame, timestamp, number, key in self.frames():
+                i = self.recorded
+                if i == len(frames):
+                    #grow one chunk at a time
+                    for dataset in datasets:
+                        dataset.resize(i + self.chunk_frames, axis=0)
+                frames[i] = frame
+                timestamps[i] = timestamp
+                sequence[i] = number
+                settings[i] = key
+                self.recorded += 1
+            for dataset in datasets:
+                dataset.resize(self.recorded, axis=0)
+
+    def write_raw(self):
+        metadata = dict((key, value.tolist() if isinstance(value, numpy.ndarray) else value)
+                        for key, value in self.metadata.items())
+        metadata["nr_of_pixels"] = self.nr_of_pixels
+        metadata["dtype"] = "<f8"
+        metadata["settings_columns"] = SETTINGS_COLUMNS
+        if self.wavelengths is not None:
+            metadata["wavelengths"] = numpy.asarray(self.wavelengths).tolist()
+        with open(self.path + ".json", "w") as f:
+            json.dump(metadata, f)
+        with open(self.path + ".raw", "wb") as data, open(self.path + ".idx", "w") as index:
+            for frame, timestamp, number, key in self.frames():
+                frame.astype("<f8").tofile(data)
+                index.write("%d %.6f %s\n" %(number, timestamp, " ".join("%d" %k for k in key)))
+                self.recorded += 1
+
+
+
+def load_raw(path):
+    """Open a raw recording. Returns (frames as a read-only memory map,
+    index array with columns sequence, timestamp, settings..., metadata)."""
+    with open(path + ".json") as f:
+        metadata = json.load(f)
+    frames = numpy.memmap(path + ".raw", dtype=metadata["dtype"], mode="r")
+    frames = frames.reshape(-1, metadata["nr_of_pixels"])
+    index = numpy.loadtxt(path + ".idx", ndmin=2)
+    return frames, index, metadata
@@ -0,0 +1,305 @@
+#Simulated OmniDriver backend. SimulatedOmniDriver reproduces the
+#Wrapper_*, Coefficients_*, JString_* and DoubleArray_* call surface used by
+#PyOceansOpticsWrapper, so the wrapper, the Tango devices and the acquisition
+#pipeline run without the vendor SDK or a spectrometer. Select it with the
+#environment variable OMNIDRIVER_BACKEND=sim (see OmniDriverSession).
+
+import os
+import threading
+import time
+from ctypes import POINTER, c_double
+
+import numpy
+
+
+
+class SimulatedSpectrometer:
+    """Model of one spectrometer: a fixed scene of emission lines on a smooth
+    background, counts proportional to the integration time, a dark offset,
+    shot and read noise, and saturation at the maximum intensity."""
+
+    def __init__(self, serial_number, name="HR4000", nr_of_pixels=3648,
+                 max_intensity=16383, min_integration_time=3800,
+                 max_integration_time=10000000, dark_level=100.0,
+                 read_noise=5.0, firmware_version="1.0.0", seed=None):
+        self.serial_number = serial_number
+        self.name = name
+        self.nr_of_pixels = nr_of_pixels
+        self.max_intensity = max_intensity
+        self.min_integration_time = min_integration_time
+        self.max_integration_time = max_integration_time
+        self.dark_level = dark_level
+        self.read_noise = read_noise
+        self.firmware_version = firmware_version
+        self.integration_time = 100000
+        self.scans_to_average = 1
+        self.correct_electrical_dark = 0
+        self.correct_nonlinearity = 0
+        self.correct_stray_light = 0
+        self.timeout = 0
+        self.saturated = 0
+        self.stop_averaging = False
+        self.random = numpy.random.RandomState(seed)
+        #wavelength polynomial (intercept, first, second, third) as in the eeprom
+        self.wl_coef = [200.0, 800.0/nr_of_pixels, -1e-6, 0.0]
+        self.nl_coef = [1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+        self.nl_order = 7
+        self.stray_light = 0.0
+        pixels = numpy.arange(nr_of_pixels)
+        self.wavelengths = numpy.polyval(self.wl_coef[::-1], pixels)
+        #signal rate in counts per second
+        self.rate = 2000.0 + 1000.0*numpy.exp(-((self.wavelengths - 550.0)/150.0)**2)
+        for centre, height, width in [(436.0, 60000.0, 1.5), (546.0, 90000.0, 1.5),
+                                      (577.0, 30000.0, 2.0), (656.0, 45000.0, 1.0)]:
+            self.rate += height*numpy.exp(-0.5*((self.wavelengths - centre)/width)**2)
+
+    def acquire(self, out, realtime=True):
+        """Fill out with one spectrum (averaged over scans_to_average scans)."""
+        scans = max(1, self.scans_to_average)
+        exposure = self.integration_time/1e6
+        out.fill(0)
+        done = 0
+        for scan in range(scans):
+            if self.stop_averaging and done:
+                break
+            if realtime:
+                time.sleep(exposure)
+            signal = self.rate*exposure
+            counts = self.random.poisson(signal).astype(float)
+            counts += self.dark_level + self.random.normal(0, self.read_noise, self.nr_of_pixels)
+            numpy.clip(counts, 0, self.max_intensity, out=counts)
+            out += counts
+            done += 1
+        self.stop_averaging = False
+        out /= done
+        self.saturated = int(numpy.max(out) >= self.max_intensity)
+        if self.correct_electrical_dark:
+            out -= self.dark_level
+
+
+
+class RecordedSpectrometer(SimulatedSpectrometer):
+    """Spectrometer replaying the frames of a recording in a loop.
+
+    Recorded frames lack the three leading pixels the driver returns (see
+    OceansOpticsWrapper.GetSpectrum), so they are padded back in."""
+
+    def __init__(self, serial_number, frames, wavelengths=None, **kwargs):
+        frames = numpy.asarray(frames, dtype=float)
+        SimulatedSpectrometer.__init__(self, serial_number,
+                                       nr_of_pixels=frames.shape[1] + 3, **kwargs)
+        self.frames = frames
+        self.position = 0
+        if wavelengths is not None:
+            wavelengths = numpy.asarray(wavelengths, dtype=float)
+            self.wavelengths = numpy.concatenate([numpy.repeat(wavelengths[:1], 3), wavelengths])
+
+    @classmethod
+    def from_file(cls, path, serial_number="RECORDED", **kwargs):
+        """Load an HDF5 recording, or the raw recording path(.raw/.idx/.json)."""
+        if path.endswith(".h5") or path.endswith(".hdf5"):
+            import h5py
+            with h5py.File(path, "r") as f:
+                wavelengths = f["wavelengths"][()] if "wavelengths" in f else None
+                return cls(serial_number, f["frames"][()], wavelengths, **kwargs)
+        import lib_recorder
+        frames, index, metadata = lib_recorder.load_raw(path)
+        return cls(serial_number, numpy.array(frames), metadata.get("wavelengths"), **kwargs)
+
+    def acquire(self, out, realtime=True):
+        if realtime:
+            time.sleep(self.integration_time/1e6*max(1, self.scans_to_average))
+        out[:3] = 0
+        out[3:] = self.frames[self.position % len(self.frames)]
+        self.position += 1
+        self.saturated = int(numpy.max(out) >= self.max_intensity)
+
+
+
+class SimulatedOmniDriver:
+    """Pure Python stand-in for libOmniDriver/libcommon.
+
+    Handles returned by the *_Create functions are integers; the functions
+    accept them bare or wrapped in ctypes objects."""
+
+    def __init__(self, spectrometers=None, realtime=True):
+        if spectrometers is None:
+            spectrometers = [SimulatedSpectrometer("HR4C5720", "HR4000", 3648, 16383, 3800, seed=1),
+                             SimulatedSpectrometer("QEPB0353", "QE65000", 1044, 65535, 8000, seed=2)]
+        self.spectrometers = spectrometers
+        self.realtime = realtime
+        self.opened = []
+        self.objects = {}
+        self.next_handle = 1
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        """Build a simulator from OMNIDRIVER_SIM, a comma separated list of
+        serial:pixels[:max intensity] entries, and OMNIDRIVER_SIM_REALTIME
+        (0 disables the integration time delays)."""
+        realtime = os.environ.get("OMNIDRIVER_SIM_REALTIME", "1") != "0"
+        config = os.environ.get("OMNIDRIVER_SIM", "")
+        if not config:
+            return cls(realtime=realtime)
+        spectrometers = []
+        for i, entry in enumerate(config.split(",")):
+            fields = entry.split(":")
+            kwargs = {"nr_of_pixels": int(fields[1]) if len(fields) > 1 else 3648,
+                      "seed": i}
+            if len(fields) > 2:
+                kwargs["max_intensity"] = int(fields[2])
+            spectrometers.append(SimulatedSpectrometer(fields[0], **kwargs))
+        return cls(spectrometers, realtime)
+
+    #handles
+    def create(self, value):
+        with self.lock:
+            handle = self.next_handle
+            self.next_handle += 1
+            self.objects[handle] = value
+        return handle
+
+    def get(self, handle):
+        return self.objects[getattr(handle, "value", handle)]
+
+    def set(self, handle, value):
+        self.objects[getattr(handle, "value", handle)] = value
+
+    def spectrometer(self, index):
+        return self.opened[getattr(index, "value", index)]
+
+    #common library
+    def JString_Create(self):
+        return self.create("")
+
+    def JString_getASCII(self, jstr):
+        return self.get(jstr)
+
+    def DoubleArray_Create(self):
+        return self.create(numpy.zeros(0))
+
+    def DoubleArray_getDoubleValues(self, array):
+        return self.get(array).ctypes.data_as(POINTER(c_double))
+
+    def double_array(self, array, length):
+        """The buffer behind a DoubleArray handle, resized to length."""
+        values = self.get(array)
+        if len(values) != length:
+            values = numpy.zeros(length)
+            self.set(array, values)
+        return values
+
+    #coefficients
+    def Coefficients_Create(self):
+        return self.create({"NlCoef%d" %i: 0.0 for i in range(8)})
+
+    def __getattr__(self, name):
+        #Coefficients_getX / Coefficients_setX for every coefficient
+        if name.startswith("Coefficients_get"):
+            key = name[len("Coefficients_get"):]
+            return lambda coefficients: self.get(coefficients).get(key, 0.0)
+        if name.startswith("Coefficients_set"):
+            key = name[len("Coefficients_set"):]
+            def setter(coefficients, value):
+                self.get(coefficients)[key] = getattr(value, "value", value)
+            return setter
+        raise AttributeError(name)
+
+    #wrapper
+    def Wrapper_Create(self):
+        return self.create(None)
+
+    def Wrapper_openAllSpectrometers(self, wrapper):
+        self.opened = list(self.spectrometers)
+        return len(self.opened)
+
+    def Wrapper_closeSpectrometer(self, wrapper, index):
+        pass
+
+    def Wrapper_getCalibrationCoefficientsFromBuffer(self, wrapper, index, coefficients):
+        spectrometer = self.spectrometer(index)
+        values = self.get(coefficients)
+        for i, value in enumerate(spectrometer.nl_coef):
+            values["NlCoef%d" %i] = value
+        values["NlOrder"] = spectrometer.nl_order
+        for key, value in zip(["WlIntercept", "WlFirst", "WlSecond", "WlThird"], spectrometer.wl_coef):
+            values[key] = value
+        values["StrayLight"] = spectrometer.stray_light
+
+    def Wrapper_getSerialNumber(self, wrapper, index, jstr):
+        self.set(jstr, self.spectrometer(index).serial_number)
+
+    def Wrapper_getName(self, wrapper, index, jstr):
+        self.set(jstr, self.spectrometer(index).name)
+
+    def Wrapper_getFirmwareVersion(self, wrapper, index, jstr):
+        self.set(jstr, self.spectrometer(index).firmware_version)
+
+    def Wrapper_getWavelengths(self, wrapper, index, array):
+        spectrometer = self.spectrometer(index)
+        numpy.copyto(self.double_array(array, spectrometer.nr_of_pixels), spectrometer.wavelengths)
+
+    def Wrapper_getSpectrum(self, wrapper, index, array):
+        spectrometer = self.spectrometer(index)
+        spectrometer.acquire(self.double_array(array, spectrometer.nr_of_pixels), self.realtime)
+
+    def Wrapper_getNumberOfPixels(self, wrapper, index):
+        return self.spectrometer(index).nr_of_pixels
+
+    def Wrapper_getCorrectForElectricalDark(self, wrapper, index):
+        return self.spectrometer(index).correct_electrical_dark
+
+    def Wrapper_setCorrectForElectricalDark(self, wrapper, index, enable):
+        self.spectrometer(index).correct_electrical_dark = int(enable)
+
+    def Wrapper_getCorrectForStrayLight(self, wrapper, index):
+        return self.spectrometer(index).correct_stray_light
+
+    def Wrapper_getCorrectForDetectorNonlinearity(self, wrapper, index):
+        return self.spectrometer(index).correct_nonlinearity
+
+    def Wrapper_setCorrectForDetectorNonlinearity(self, wrapper, index, enable):
+        self.spectrometer(index).correct_nonlinearity = int(enable)
+
+    def Wrapper_getIntegrationTime(self, wrapper, index):
+        return self.spectrometer(index).integration_time
+
+    def Wrapper_setIntegrationTime(self, wrapper, index, usec):
+        spectrometer = self.spectrometer(index)
+        spectrometer.integration_time = int(min(max(usec, spectrometer.min_integration_time),
+                                                spectrometer.max_integration_time))
+
+    def Wrapper_getScansToAverage(self, wrapper, index):
+        return self.spectrometer(index).scans_to_average
+
+    def Wrapper_setScansToAverage(self, wrapper, index, number):
+        self.spectrometer(index).scans_to_average = int(number)
+
+    def Wrapper_getMinimumIntegrationTime(self, wrapper, index):
+        return self.spectrometer(index).min_integration_time
+
+    def Wrapper_getMaximumIntegrationTime(self, wrapper, index):
+        return self.spectrometer(index).max_integration_time
+
+    def Wrapper_getMaximumIntensity(self, wrapper, index):
+        return self.spectrometer(index).max_intensity
+
+    def Wrapper_isSaturated(self, wrapper, index):
+        return self.spectrometer(index).saturated
+
+    def Wrapper_isTimeout(self, wrapper, index):
+        return self.spectrometer(index).timeout
+
+    def Wrapper_setTimeout(self, wrapper, index, msec):
+        self.spectrometer(index).timeout = 0
+        return 0
+
+    def Wrapper_isSpectrumValid(self, wrapper, index):
+        return 1
+
+    def Wrapper_stopAveraging(self, wrapper, index):
+        self.spectrometer(index).stop_averaging = True
+
+    def Wrapper_flushSpectrum(self, wrapper, index):
+        return 1
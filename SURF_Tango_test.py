@@ -3,7 +3,6 @@ import tango
 #initialize Monochromator
 print("-------------------------------------------------")
 M = tango.DeviceProxy('test/Cornerstone/1')
-M.set_timeout_millis(30000)
 print("--------Monochromator Initialized as M-----------")
 #Initialize pump
 P = tango.DeviceProxy('test/XLP6000/1')
@@ -16,8 +15,10 @@ FL = tango.DeviceProxy('test/QE65000/1')
 print("--------Fl Spectrometer Initialized as FL--------")
 print("-------------------------------------------------")
 print("--------Command sequence example:----------------")
+print("import time")
 print("import matplotlib.pyplot as plt")
 print("M.wavelength=550")
+print("while M.state() == tango.DevState.MOVING: time.sleep(0.1)")
 print("M.shutter = 1")
 print("FL.darkcorrection = True")
 print("FL.integrationtime=5000")
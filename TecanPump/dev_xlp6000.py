@@ -1,17 +1,30 @@
+import asyncio
+import os
+import sys
+import threading
+
 import numpy
 import PyTango
-from PyTango import DispLevel, AttrWriteType, DevState
+from PyTango import DispLevel, AttrWriteType, DevState, GreenMode
 from PyTango.server import DeviceMeta, Device, server_run
 from PyTango.server import command, attribute, device_property
 
 import lib_xlp6000
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+import lib_instrumentation
+
 class xlp6000(Device):
     """XLP6000 pump class"""
 
     __metaclass__ = DeviceMeta
+    #handlers run on an asyncio event loop and await the pump in executor
+    #threads, so one slow pump answer does not hold up the other clients
+    green_mode = GreenMode.Asyncio
     #properties
     serial_port = device_property(dtype = str, default_value= "/dev/ttyUSB0")
+    serial_transport = device_property(dtype = bool, default_value = False,
+                                       doc = "Send the commands through the asyncio serial transport (lib_serialtransport): they return when the pump answers instead of after the 2 s serial timeout.")
 
     #attributes
     top_speed = attribute(label="Top speed",
@@ -93,16 +106,54 @@ class xlp6000(Device):
                                               access = AttrWriteType.READ_WRITE,
                                               doc = "In fine positioning mode max is 248. in normal mode max is 31")
 
+    #call statistics
+    CallStatistics = attribute(label = "Call statistics", unit = "",
+                               display_level=DispLevel.EXPERT,
+                               dtype=[str,],
+                               max_dim_x=lib_instrumentation.MAX_OPERATIONS, max_dim_y=0,
+                               access = AttrWriteType.READ,
+                               doc = "One line per pump command or query: calls, errors and mean, median, 99th percentile and maximum latency in micro seconds.")
+
+    CallCount = attribute(label = "Call count", unit = "calls",
+                          display_level=DispLevel.EXPERT,
+                          dtype = int, access = AttrWriteType.READ,
+                          doc = "Number of pump command or query calls since start or the last ResetCallStatistics.")
+
+    CallErrors = attribute(label = "Call errors", unit = "calls",
+                           display_level=DispLevel.EXPERT,
+                           dtype = int, access = AttrWriteType.READ,
+                           doc = "Number of pump command or query calls that raised an error.")
+
+    CallHistograms = attribute(label = "Call latency histograms", unit = "calls",
+                               display_level=DispLevel.EXPERT,
+                               dtype=((int,),),
+                               max_dim_x=lib_instrumentation.NUMBER_OF_BUCKETS,
+                               max_dim_y=lib_instrumentation.MAX_OPERATIONS,
+                               access = AttrWriteType.READ,
+                               doc = "Latency histogram of each pump command or query, one row per line of CallStatistics, buckets as in CallHistogramEdges.")
+
+    CallHistogramEdges = attribute(label = "Call histogram edges", unit = "micro seconds",
+                                   display_level=DispLevel.EXPERT,
+                                   dtype=[float,],
+                                   max_dim_x=lib_instrumentation.NUMBER_OF_BUCKETS, max_dim_y=0,
+                                   access = AttrWriteType.READ,
+                                   doc = "Upper latency limit of every CallHistograms bucket.")
+
 
         
 
-    def init_device(self):
-        Device.init_device(self)
+    #the pump initialisation takes seconds; it is awaited like any other
+    #pump call, so an Init does not block the other clients
+    async def init_device(self):
+        await Device.init_device(self)
         self.set_state(PyTango.DevState.INIT)
         self.set_status("Device in init!")
+        #one pump command at a time
+        self.lock = threading.Lock()
         try:
-            self.pump = lib_xlp6000.Pump(serial_port=self.serial_port)
-            self.pump.move_valve_to_input_port()
+            self.pump = await self.hardware(lambda: lib_xlp6000.Pump(serial_port=self.serial_port,
+                                                                     transport=self.serial_transport))
+            await self.hardware(self.pump.move_valve_to_input_port)
             self.pump.microstepmode=0
             self.set_state(PyTango.DevState.ON)
             self.set_status("Device is ON!")
@@ -112,20 +163,27 @@ class xlp6000(Device):
             self.set_state(PyTango.DevState.FAULT)
             self.set_status("Device could not initialize!")
 
+    #run a (blocking) pump call in an executor thread
+    async def hardware(self, function, *args):
+        def call():
+            with self.lock:
+                return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, call)
+
     #read commands
-    def read_top_speed(self):
-        return int(self.pump.get_top_speed())
-    def read_cutoff_speed(self):
-        return int(self.pump.get_cutoff_speed())
-    def read_start_speed(self):
-        return int(self.pump.get_start_speed())
-    def read_plunger_position(self):
-        return int(self.pump.get_actual_plunger_position())
+    async def read_top_speed(self):
+        return int(await self.hardware(self.pump.get_top_speed))
+    async def read_cutoff_speed(self):
+        return int(await self.hardware(self.pump.get_cutoff_speed))
+    async def read_start_speed(self):
+        return int(await self.hardware(self.pump.get_start_speed))
+    async def read_plunger_position(self):
+        return int(await self.hardware(self.pump.get_actual_plunger_position))
         #p = float(self.pump.get_actual_plunger_position())
         #p = int(6*float(p-1475))
         return p
-    def read_valve_position(self):
-        response = self.pump.get_valve_position()
+    async def read_valve_position(self):
+        response = await self.hardware(self.pump.get_valve_position)
         if response == "i":
             response = 0
         elif response == "o":
@@ -135,51 +193,75 @@ class xlp6000(Device):
         else:
             raise ValueError("valve position passed from pump must be either i, o or b.")
         return response
-    def read_device_status(self):
-        return self.pump.get_error_code()
-    def read_voltage(self):
-        return float(self.pump.get_voltage())/10
-    def read_plunger_acceleration(self):
-        return int(self.pump.get_slope_code_setting())
-    def read_microstepmode(self):
-        return int(self.pump.get_current_mode())
-    def read_number_of_backlash_increments(self):
-        return int(self.pump.get_number_of_backlash_increments())
+    async def read_device_status(self):
+        return await self.hardware(self.pump.get_error_code)
+    async def read_voltage(self):
+        return float(await self.hardware(self.pump.get_voltage))/10
+    async def read_plunger_acceleration(self):
+        return int(await self.hardware(self.pump.get_slope_code_setting))
+    async def read_microstepmode(self):
+        return int(await self.hardware(self.pump.get_current_mode))
+    async def read_number_of_backlash_increments(self):
+        return int(await self.hardware(self.pump.get_number_of_backlash_increments))
 
     #write commands
-    def write_top_speed(self, n):
-        self.pump.set_top_speed(n)
-    def write_cutoff_speed(self, n):
-        self.pump.set_cutoff_speed(n)
-    def write_start_speed(self, n):
-        self.pump.set_start_speed(n)
-    def write_plunger_position(self, n):
-        self.pump.move_plunger_absolute_position(n)
-    def write_valve_position(self, n):
+    async def write_top_speed(self, n):
+        await self.hardware(self.pump.set_top_speed, n)
+    async def write_cutoff_speed(self, n):
+        await self.hardware(self.pump.set_cutoff_speed, n)
+    async def write_start_speed(self, n):
+        await self.hardware(self.pump.set_start_speed, n)
+    async def write_plunger_position(self, n):
+        await self.hardware(self.pump.move_plunger_absolute_position, n)
+    async def write_valve_position(self, n):
         if n==0:
-            self.pump.move_valve_to_input_port()
+            await self.hardware(self.pump.move_valve_to_input_port)
         elif n==1:
-            self.pump.move_valve_to_output_port()
+            await self.hardware(self.pump.move_valve_to_output_port)
         elif n==2:
-            self.pump.move_valve_to_bypass_position()
-    def write_plunger_acceleration(self, n):
-        self.pump.set_slope(n)
-    def write_microstepmode(self,n):
-        self.pump.microstepmode(n)
-    def write_number_of_backlash_increments(self, n):
-        self.pump.backlash_increments(n)
+            await self.hardware(self.pump.move_valve_to_bypass_position)
+    async def write_plunger_acceleration(self, n):
+        await self.hardware(self.pump.set_slope, n)
+    async def write_microstepmode(self,n):
+        await self.hardware(self.pump.microstepmode, n)
+    async def write_number_of_backlash_increments(self, n):
+        await self.hardware(self.pump.backlash_increments, n)
+
+    def read_CallStatistics(self):
+        return self.pump.instrumentation.statistics()
+
+    def read_CallCount(self):
+        return self.pump.instrumentation.totals()[0]
+
+    def read_CallErrors(self):
+        return self.pump.instrumentation.totals()[1]
+
+    def read_CallHistograms(self):
+        histograms = numpy.array(self.pump.instrumentation.histograms(), dtype=int)
+        return histograms.reshape(-1, lib_instrumentation.NUMBER_OF_BUCKETS)
+
+    def read_CallHistogramEdges(self):
+        return lib_instrumentation.bucket_edges()
+
+    @command
+    def ResetCallStatistics(self):
+        self.pump.instrumentation.reset()
 
     @command
-    def terminate(self):
-        self.pump.terminate_current_command()
+    async def terminate(self):
+        await self.hardware(self.pump.terminate_current_command)
     @command
-    def simulated_plunger_initialization(self):
-        self.pump.simulated_plunger_initialization()
+    async def simulated_plunger_initialization(self):
+        await self.hardware(self.pump.simulated_plunger_initialization)
 
 
 
 
 
 if __name__ == "__main__":
-    xlp6000.run_server()
+    util = PyTango.Util(sys.argv)
+    #no device level lock around the handlers, so they can interleave on the
+    #event loop; the pump calls are serialised by self.lock
+    util.set_serial_model(PyTango.SerialModel.NO_SYNC)
+    xlp6000.run_server(util=util)
         
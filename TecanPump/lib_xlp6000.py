@@ -1,17 +1,36 @@
+import os
+import sys
 import serial                            
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+import lib_instrumentation
+
+
+#seconds to wait for the answer block of a command or query through the
+#serial transport
+TIMEOUT = 2.0
+
 
 
 class Pump:
-    #command helper function
+    #command helper function, timed per command letter (A, V, Z, ...)
     def command(self, cmd):
-        self.ser.write(self.pump_port+cmd+"R\r")
-        self.ser.readlines()
-    #query helper function
+        with self.instrumentation.timed(cmd.rstrip("0123456789,-")):
+            if self.port is not None:
+                self.port.transaction((self.pump_port+cmd+"R\r").encode("latin-1"), 1, TIMEOUT)
+                return
+            self.ser.write((self.pump_port+cmd+"R\r").encode("latin-1"))
+            self.ser.readlines()
+    #query helper function, timed per query (?4, *, ...)
     def query(self, q):
-        self.ser.write(self.pump_port+q+"R\r")
-        response = self.ser.readlines()
-        return response[0][4:-3]
+        with self.instrumentation.timed(q):
+            if self.port is not None:
+                response = self.port.transaction((self.pump_port+q+"R\r").encode("latin-1"), 1, TIMEOUT)
+                #strip the start of the answer block and ETX CR LF
+                return response[0].decode("latin-1")[4:-3]
+            self.ser.write((self.pump_port+q+"R\r").encode("latin-1"))
+            response = self.ser.readlines()
+            return response[0].decode("latin-1")[4:-3]
 
     #===========================#
     #Pump Configuration Commands#
@@ -28,17 +47,29 @@ class Pump:
     #=======================#
     #Initialization Commands#
     #=======================#
-    #Constructor
-    def __init__(self,serial_port='/dev/ttyUSB0', pump_port = "/1", polarity=0):
+    #Constructor. With transport the serial link goes through
+    #lib_serialtransport (Python 3): True opens a SyncSerialTransport on
+    #serial_port, or pass one already opened, e.g. shared by all the pumps
+    #on one RS-232 bus. Its queue then serialises their commands.
+    def __init__(self,serial_port='/dev/ttyUSB0', pump_port = "/1", polarity=0, transport=None):
         self.pump_port = pump_port
+        self.instrumentation = lib_instrumentation.Instrumentation()
         print(pump_port)
-        self.ser = serial.Serial(port = serial_port,
-                    baudrate = 9600,      
-                    bytesize = serial.EIGHTBITS,
-                    parity = serial.PARITY_NONE,
-                    stopbits = serial.STOPBITS_ONE,                         
-                    timeout = 2)
-	self.ser.readlines()               
+        self.port = None
+        self.ser = None
+        if transport is True:
+            import lib_serialtransport
+            self.port = lib_serialtransport.SyncSerialTransport(serial_port, baudrate=9600)
+        elif transport:
+            self.port = transport
+        else:
+            self.ser = serial.Serial(port = serial_port,
+                        baudrate = 9600,      
+                        bytesize = serial.EIGHTBITS,
+                        parity = serial.PARITY_NONE,
+                        stopbits = serial.STOPBITS_ONE,                         
+                        timeout = 2)
+            self.ser.readlines()               
         if polarity == 0:
             print("clockwise")
             self.init_plunger_and_valve_clockwise()